@@ -1,8 +1,13 @@
+import hashlib
+
 from django.contrib.auth.models import AbstractUser
 from django.contrib.sites.models import Site
 from django.db import models
+from django.db.models import OuterRef, Subquery
 from django.urls import reverse
 
+from website.utils import cache
+
 
 class BlogUser(AbstractUser):
     nickname = models.CharField(max_length=100, blank=True)
@@ -22,3 +27,27 @@ class BlogUser(AbstractUser):
         site = Site.objects.get_current().domain
         url = "https://{site}{path}".format(site=site, path=self.get_absolute_url())
         return url
+
+    @staticmethod
+    def get_avatar_cache_key(id):
+        return 'user_avatar_{id}'.format(id=id)
+
+    @staticmethod
+    def get_avatars(ids):
+        """(OAuth picture or '', gravatar hash) of each user id, cached per user without the email."""
+        from oauth.models import OAuthUser
+
+        keys = {id: BlogUser.get_avatar_cache_key(id) for id in set(ids)}
+        cached = cache.get_many(keys.values())
+        avatars = {id: cached[key] for id, key in keys.items() if key in cached}
+        missing = [id for id in keys if id not in avatars]
+        if missing:
+            # the picture of the first account with one for the user's email, as in OAuthUser.get_pictures
+            pictures = OAuthUser.objects.filter(email=OuterRef('email'), picture__isnull=False).order_by('id')
+            users = BlogUser.objects.filter(id__in=missing) \
+                .annotate(picture=Subquery(pictures.values('picture')[:1])).values_list('id', 'email', 'picture')
+            loaded = {id: (picture or '', hashlib.md5(email.lower().encode('utf-8')).hexdigest())
+                      for id, email, picture in users}
+            cache.set_many({keys[id]: avatar for id, avatar in loaded.items()})
+            avatars.update(loaded)
+        return avatars
@@ -35,8 +35,6 @@ class LogoutView(RedirectView):
         return super(LogoutView, self).dispatch(request, *args, **kwargs)
 
     def get(self, request, *args, **kwargs):
-        from website.utils import cache
-        cache.clear()
         logout(request)
         return super(LogoutView, self).get(request, *args, **kwargs)
 
@@ -66,9 +64,6 @@ class LoginView(FormView):
         form = AuthenticationForm(data=self.request.POST, request=self.request)
 
         if form.is_valid():
-            from website.utils import cache
-            if cache and cache is not None:
-                cache.clear()
             print(self.redirect_field_name)
             redirect_to = self.request.GET.get(self.redirect_field_name)
             auth.login(self.request, form.get_user())
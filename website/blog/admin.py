@@ -1,10 +1,21 @@
+import json
+
 from django import forms
 from django.contrib import admin
 from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponseRedirect
+from django.urls import path, reverse
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import require_POST
 from django.utils.translation import ugettext_lazy as _
 from pagedown.widgets import AdminPagedownWidget
 
+from website.blog_signals import articles_status_changed
+from website.utils import cache
+
 # Register your models here.
+from .analytics import get_view_chart
 from .models import Article, Category, Tag, Links, SideBar
 
 
@@ -34,11 +45,15 @@ class ArticleForm(forms.ModelForm):
 
 
 def makr_article_publish(modeladmin, request, queryset):
+    ids = list(queryset.values_list('id', flat=True))
     queryset.update(status='p')
+    articles_status_changed(ids)
 
 
 def draft_article(modeladmin, request, queryset):
+    ids = list(queryset.values_list('id', flat=True))
     queryset.update(status='d')
+    articles_status_changed(ids)
 
 
 def close_article_commentstatus(modeladmin, request, queryset):
@@ -72,10 +87,23 @@ class ArticlelAdmin(admin.ModelAdmin):
         form.base_fields['author'].queryset = get_user_model().objects.filter(is_superuser=True)
         return form
 
-    def save_model(self, request, obj, form, change):
-        super(ArticlelAdmin, self).save_model(request, obj, form, change)
-        from website.utils import cache
+    def get_urls(self):
+        # a changelist button rather than an action, which Django only runs on a selection
+        clear_cache = self.admin_site.admin_view(require_POST(self.clear_whole_cache_view))
+        return [path('clear-cache/', clear_cache, name='blog_article_clear_cache')] + super().get_urls()
+
+    def clear_whole_cache_view(self, request):
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        # saves invalidate their own dependency tags; this is the explicit escape hatch
         cache.clear()
+        self.message_user(request, 'The whole cache was cleared.')
+        return HttpResponseRedirect(reverse('admin:blog_article_changelist'))
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['view_chart'] = mark_safe(json.dumps(get_view_chart()))
+        return super(ArticlelAdmin, self).changelist_view(request, extra_context)
 
     class Media:
         js = ("https://cdnjs.cloudflare.com/ajax/libs/Chart.js/2.4.0/Chart.min.js",)
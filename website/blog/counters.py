@@ -0,0 +1,189 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Case, F, When
+
+from blog.analytics import DailyViewStats
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter():
+    """Buffers article view increments in the process and writes them in one UPDATE.
+
+    Each worker keeps its own buffer, so a flush never double counts; other workers'
+    unflushed views become visible after their next flush. Flushes run on a daemon
+    thread every VIEW_COUNT_FLUSH_INTERVAL seconds, or sooner once the buffer reaches
+    VIEW_COUNT_FLUSH_THRESHOLD, so no request waits for one and idle workers still write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def record(self, article_id, visitor=None):
+        daily_view_stats.record(article_id, visitor)
+        with self._lock:
+            self._pending[article_id] += 1
+            due = sum(self._pending.values()) >= settings.VIEW_COUNT_FLUSH_THRESHOLD
+        self.start_flusher()
+        if due:
+            self._wake.set()
+
+    def pending(self, article_id):
+        return self._pending.get(article_id, 0)
+
+    def start_flusher(self):
+        # threads do not survive a fork, so each worker starts its own on its first view
+        if self._flusher_pid == os.getpid() or self._stopped.is_set():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            self._flusher = threading.Thread(target=self.run_flusher, name='view-counter-flush', daemon=True)
+            self._flusher.start()
+
+    def run_flusher(self):
+        while not self._stopped.is_set():
+            self._wake.wait(settings.VIEW_COUNT_FLUSH_INTERVAL)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('view counter flush failed: %s' % e)
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        """Stop the flush thread and write what is left."""
+        self._stopped.set()
+        self._wake.set()
+        self.flush()
+
+    def flush(self):
+        """Add the buffered views to Article.views; returns the {id: delta} written."""
+        from blog.models import Article
+
+        daily_view_stats.flush()
+        with self._lock:
+            deltas = self._pending
+            self._pending = Counter()
+        if not deltas:
+            return {}
+        try:
+            Article.objects.filter(id__in=deltas).update(views=Case(
+                *[When(id=id, then=F('views') + delta) for id, delta in deltas.items()],
+                default=F('views')
+            ))
+        except Exception as e:
+            logger.error('flush article views failed: %s' % e)
+            with self._lock:
+                self._pending.update(deltas)
+            return {}
+        logger.info('flushed views of {count} articles'.format(count=len(deltas)))
+        most_read_index.update_articles(deltas)
+        Article.expire_cached_articles(deltas)
+        return dict(deltas)
+
+
+class MostReadIndex():
+    """The most read published articles, kept in the cache and updated incrementally.
+
+    Stores up to twice the requested size as (views, id) pairs, highest first, and a
+    floor: every published article outside the stored window ranks at or below it.
+    Views only grow, so an outside article can only enter through an update of its
+    own. The window is rebuilt from the database only when removals shrink it below
+    the requested size.
+    """
+    cache_key = 'most_read_articles'
+    # updates read, merge and write the shared value, so they take turns
+    lock_key = 'lock_most_read_articles'
+    lock_timeout = 10
+    lock_wait = 2
+
+    def __init__(self, size):
+        self.size = size
+        self.capacity = size * 2
+
+    @staticmethod
+    def merge(value, views, removed, capacity):
+        """Apply {id: views} updates and removed ids to an index value; returns the new value."""
+        entries, floor = value['entries'], value['floor']
+        known = {id for _, id in entries}
+        changed = set(views) | set(removed)
+        entries = [e for e in entries if e[1] not in changed]
+        entries.extend((v, id) for id, v in views.items() if id in known or floor is None or (v, id) > floor)
+        entries.sort(reverse=True)
+        if len(entries) > capacity:
+            floor = max(floor, entries[capacity]) if floor else entries[capacity]
+            entries = entries[:capacity]
+        return {'entries': entries, 'floor': floor}
+
+    def rebuild(self):
+        from blog.models import Article
+
+        entries = list(Article.objects.filter(status='p').order_by('-views', '-id')
+                       .values_list('views', 'id')[:self.capacity])
+        # no floor when the window already holds every published article
+        floor = entries[-1] if len(entries) == self.capacity else None
+        value = {'entries': entries, 'floor': floor}
+        cache.set(self.cache_key, value)
+        return value
+
+    def get(self):
+        value = cache.get(self.cache_key)
+        if value is None or (value['floor'] is not None and len(value['entries']) < self.size):
+            value = self.rebuild()
+        return value
+
+    def get_ids(self):
+        return [id for _, id in self.get()['entries'][:self.size]]
+
+    def update_articles(self, ids):
+        """Re-read views and status of the given articles and merge them into the index.
+
+        Without the lock a concurrent update could write back a value read before this one,
+        dropping an article that just rose above the floor. When the lock cannot be taken
+        within lock_wait seconds the index is rebuilt instead.
+        """
+        from blog.models import Article
+
+        if cache.get(self.cache_key) is None:
+            return
+        ids = set(ids)
+        deadline = time.monotonic() + self.lock_wait
+        while not cache.add(self.lock_key, 1, self.lock_timeout):
+            if time.monotonic() > deadline:
+                logger.warning('most read index is locked, rebuilding it')
+                self.rebuild()
+                return
+            time.sleep(0.05)
+        try:
+            value = cache.get(self.cache_key)
+            if value is None:
+                return
+            # read inside the lock so an older read never overwrites a newer one
+            views = dict(Article.objects.filter(id__in=ids, status='p').values_list('id', 'views'))
+            cache.set(self.cache_key, self.merge(value, views, ids - set(views), self.capacity))
+        finally:
+            cache.delete(self.lock_key)
+
+
+daily_view_stats = DailyViewStats()
+most_read_index = MostReadIndex(settings.SIDEBAR_ARTICLE_COUNT)
+view_counter = ViewCounter()
+# write what is left when the worker shuts down
+atexit.register(view_counter.stop)
@@ -0,0 +1,60 @@
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.http import Http404
+
+from blog.models import Category, Tag
+from website.utils import ProcessSnapshot
+
+DirectoryEntry = namedtuple('DirectoryEntry', 'id name slug')
+
+
+class Directory():
+    """Immutable lookup tables from slugs, usernames and names to (id, name, slug) entries."""
+
+    def __init__(self, categories, tags, authors):
+        self.by_slug = {
+            'category': {e.slug: e for e in categories},
+            'tag': {e.slug: e for e in tags},
+            'author': {e.slug: e for e in authors},
+        }
+        self.by_name = {
+            'category': {e.name: e for e in categories},
+            'tag': {e.name: e for e in tags},
+            'author': {e.name: e for e in authors},
+        }
+
+    def get(self, kind, slug):
+        return self.by_slug[kind].get(slug)
+
+    def get_by_name(self, kind, name):
+        return self.by_name[kind].get(name)
+
+
+def build_directory():
+    categories = [DirectoryEntry(*row) for row in Category.objects.values_list('id', 'name', 'slug')]
+    tags = [DirectoryEntry(*row) for row in Tag.objects.values_list('id', 'name', 'slug')]
+    # an author's slug in the urls is the username
+    authors = [DirectoryEntry(id, username, username)
+               for id, username in get_user_model().objects.values_list('id', 'username')]
+    return Directory(categories, tags, authors)
+
+
+slug_directory = ProcessSnapshot('slug_directory', build_directory)
+
+
+def resolve(kind, slug):
+    """The entry for a category or tag slug or an author username, or None."""
+    return slug_directory.get().get(kind, slug)
+
+
+def resolve_or_404(kind, slug):
+    entry = resolve(kind, slug)
+    if entry is None:
+        raise Http404('No {kind} matches {slug}'.format(kind=kind, slug=slug))
+    return entry
+
+
+def resolve_name(kind, name):
+    """The entry for a category, tag or author display name, or None."""
+    return slug_directory.get().get_by_name(kind, name)
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.models import Article
+from website.utils import CommonMarkdown, get_highlight_stats
+
+SAMPLE_BODY = '\n\n'.join([
+    '# Sample article',
+    'Plain paragraph with an [internal link](https://blog.abhilashjosephc.com/blog/) and '
+    'an [external one](https://www.djangoproject.com/ "Django").',
+    '\n'.join('* <https://example.com/item/%d>' % i for i in range(20)),
+    '```python\ndef hello():\n    print("hello world")\n```',
+])
+
+
+class Command(BaseCommand):
+    help = 'Compare per-call markdown cost of a fresh parser against the shared one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--article', type=int, help='benchmark the body of this article id')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        body = SAMPLE_BODY
+        if options['article']:
+            body = Article.objects.get(pk=options['article']).body
+
+        def fresh(value):
+            return CommonMarkdown.create_markdown()(value)
+
+        # warm up the site domain and pygments so neither run pays for imports
+        CommonMarkdown.get_markdown(body)
+        for name, render in (('fresh parser', fresh), ('shared parser', CommonMarkdown.get_markdown)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                render(body)
+            elapsed = time.perf_counter() - start
+            self.stdout.write('{name}: {per_call:.3f} ms/call over {n} calls'.format(
+                name=name, per_call=elapsed * 1000 / iterations, n=iterations))
+        self.stdout.write('highlight cache: {stats}'.format(stats=get_highlight_stats()))
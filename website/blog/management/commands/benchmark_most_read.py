@@ -0,0 +1,49 @@
+import heapq
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.counters import MostReadIndex
+
+
+class Command(BaseCommand):
+    help = 'Compare the most read index against sorting all articles, on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=100000)
+        parser.add_argument('--size', type=int, default=10)
+        parser.add_argument('--flushes', type=int, default=1000, help='view flushes to simulate')
+        parser.add_argument('--flush-size', type=int, default=50, help='articles touched per flush')
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        size, count = options['size'], options['articles']
+        index = MostReadIndex(size)
+        views = {id: int(random.paretovariate(1.2)) for id in range(1, count + 1)}
+
+        start = time.perf_counter()
+        expected = heapq.nlargest(size, ((v, id) for id, v in views.items()))
+        sort_ms = (time.perf_counter() - start) * 1000
+
+        entries = heapq.nlargest(index.capacity, ((v, id) for id, v in views.items()))
+        value = {'entries': entries, 'floor': entries[-1]}
+        ids = list(views)
+        start = time.perf_counter()
+        for _ in range(options['flushes']):
+            touched = {}
+            for id in random.sample(ids, options['flush_size']):
+                views[id] += random.randint(1, 20)
+                touched[id] = views[id]
+            value = MostReadIndex.merge(value, touched, (), index.capacity)
+        merge_ms = (time.perf_counter() - start) * 1000 / options['flushes']
+
+        start = time.perf_counter()
+        top = [id for _, id in value['entries'][:size]]
+        read_ms = (time.perf_counter() - start) * 1000
+
+        expected = [id for _, id in heapq.nlargest(size, ((v, id) for id, v in views.items()))]
+        self.stdout.write('full scan of {count} articles: {ms:.3f} ms'.format(count=count, ms=sort_ms))
+        self.stdout.write('index merge per flush: {ms:.3f} ms'.format(ms=merge_ms))
+        self.stdout.write('index read: {ms:.4f} ms'.format(ms=read_ms))
+        self.stdout.write('index matches full scan: {ok}'.format(ok=top == expected))
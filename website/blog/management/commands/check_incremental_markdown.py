@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blog.models import Article
+from comments.models import Comment
+from website.utils import CommonMarkdown
+
+
+class Command(BaseCommand):
+    help = ('Check that block-by-block rendering matches a full render for every stored article and comment; '
+            'blog.tests.IncrementalMarkdownTest covers the same over a fixed corpus')
+
+    def handle(self, *args, **options):
+        checked = fallback = 0
+        mismatches = []
+        sources = [('article', Article.objects.values_list('id', 'body')),
+                   ('comment', Comment.objects.values_list('id', 'body'))]
+        for name, rows in sources:
+            for id, body in rows.iterator():
+                checked += 1
+                incremental = CommonMarkdown.get_incremental_markdown(body)
+                if incremental is None:
+                    fallback += 1
+                elif incremental != CommonMarkdown.get_markdown(body):
+                    mismatches.append('{name} {id}'.format(name=name, id=id))
+
+        self.stdout.write('checked {checked}, rendered whole {fallback}, mismatched {count}'.format(
+            checked=checked, fallback=fallback, count=len(mismatches)))
+        if mismatches:
+            raise CommandError('incremental render differs for: ' + ', '.join(mismatches))
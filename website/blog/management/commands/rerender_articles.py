@@ -0,0 +1,121 @@
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from blog.models import Article
+from comments.models import Comment
+from website.blog_signals import after_commit
+from website.utils import CommonMarkdown, get_site_domain, invalidate_cache_tags, set_site_domain
+
+MODELS = {
+    'articles': Article,
+    'comments': Comment,
+}
+
+
+def init_worker(site_domain):
+    # links are marked nofollow against the domain the parent looked up
+    set_site_domain(site_domain)
+
+
+def render_row(row):
+    # runs in a worker process: render without touching the cache or the database
+    name, id, body = row
+    return id, MODELS[name].render_fields(body, CommonMarkdown.get_markdown(body))
+
+
+class Command(BaseCommand):
+    help = 'Re-render the stored html of articles and comments rendered by an older renderer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=sorted(MODELS), help='only re-render articles or comments')
+        parser.add_argument('--all', action='store_true', help='re-render every row, not only stale ones')
+        parser.add_argument('--ids', type=int, nargs='+', help='re-render these ids (use with --only)')
+        parser.add_argument('--since', help='only rows modified since this date or datetime')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='render processes, 0 renders in this process')
+        parser.add_argument('--batch-size', type=int, default=100, help='rows written per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='only report what would be re-rendered')
+
+    def get_queryset(self, model, options):
+        queryset = model.objects.all()
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+        elif not options['all']:
+            queryset = queryset.exclude(render_version=model.get_render_version())
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                since_date = parse_date(options['since'])
+                if since_date is None:
+                    raise CommandError('invalid --since: %s' % options['since'])
+                since = datetime.datetime.combine(since_date, datetime.time.min)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            queryset = queryset.filter(last_mod_time__gte=since)
+        return queryset
+
+    def handle(self, *args, **options):
+        names = [options['only']] if options['only'] else sorted(MODELS)
+        if options['ids'] and len(names) > 1:
+            raise CommandError('--ids needs --only articles or --only comments')
+        pending = [(name, list(self.get_queryset(MODELS[name], options).order_by('id').values_list('id', flat=True)))
+                   for name in names]
+        if options['dry_run']:
+            for name, ids in pending:
+                self.stdout.write('would re-render {count} {name}'.format(count=len(ids), name=name))
+            return
+
+        workers = options['workers']
+        executor = None
+        if workers:
+            domain = get_site_domain()
+            # forked workers must not share the parent's database connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(domain,))
+        try:
+            for name, ids in pending:
+                self.rerender(MODELS[name], name, ids, executor, options)
+        finally:
+            if executor:
+                executor.shutdown()
+
+    def rerender(self, model, name, ids, executor, options):
+        batch_size = options['batch_size']
+        start = time.perf_counter()
+        count = 0
+        for i in range(0, len(ids), batch_size):
+            rows = [(name, id, body) for id, body in
+                    model.objects.filter(id__in=ids[i:i + batch_size]).values_list('id', 'body')]
+            if executor:
+                results = executor.map(render_row, rows, chunksize=max(1, len(rows) // options['workers']))
+            else:
+                results = map(render_row, rows)
+            with transaction.atomic():
+                written = []
+                for id, fields in results:
+                    model.objects.filter(pk=id).update(**fields)
+                    written.append(id)
+                after_commit(self.expire_cached, model, written)
+            count += len(written)
+            self.stdout.write('{name}: {count}/{total}'.format(name=name, count=count, total=len(ids)))
+        elapsed = time.perf_counter() - start
+        self.stdout.write('re-rendered {count} {name} in {elapsed:.1f}s ({rate:.1f}/s)'.format(
+            count=count, name=name, elapsed=elapsed, rate=count / elapsed if elapsed else 0))
+
+    @staticmethod
+    def expire_cached(model, ids):
+        """Drop cached list entries and tagged fragments that still hold the old html."""
+        if model is Article:
+            Article.expire_cached_articles(ids)
+            article_ids = ids
+        else:
+            # cached comment lists are tagged with their article
+            article_ids = set(model.objects.filter(id__in=ids).values_list('article_id', flat=True))
+        invalidate_cache_tags(*['article:{id}'.format(id=id) for id in article_ids])
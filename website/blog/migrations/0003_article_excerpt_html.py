@@ -0,0 +1,17 @@
+# Generated by Django 2.0 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blog', '0002_article_body_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='excerpt_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
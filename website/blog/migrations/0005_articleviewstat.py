@@ -0,0 +1,33 @@
+# Generated by Django 2.0 on 2026-10-18 12:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blog', '0004_article_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleViewStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('visitors', models.BinaryField()),
+                ('article', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                              to='blog.Article')),
+            ],
+            options={
+                'verbose_name': 'Article view stat',
+                'verbose_name_plural': 'Article view stats',
+                'ordering': ['date'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='articleviewstat',
+            unique_together={('article', 'date')},
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0 on 2026-10-18 13:02
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_tag_articles(apps, schema_editor):
+    Article = apps.get_model('blog', 'Article')
+    Tag = apps.get_model('blog', 'Tag')
+    published = Article.tags.through.objects.filter(tag_id=OuterRef('pk'), article__status='p') \
+        .order_by().values('tag_id').annotate(count=Count('article_id', distinct=True)).values('count')
+    Tag.objects.update(article_count=Coalesce(Subquery(published, output_field=models.IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blog', '0005_articleviewstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='article_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_tag_articles, migrations.RunPython.noop),
+    ]
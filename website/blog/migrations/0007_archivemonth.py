@@ -0,0 +1,51 @@
+# Generated by Django 2.0 on 2026-10-18 13:40
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+
+def build_archive(apps, schema_editor):
+    Article = apps.get_model('blog', 'Article')
+    ArchiveMonth = apps.get_model('blog', 'ArchiveMonth')
+    months = Article.objects.filter(status='p').annotate(month=TruncMonth('created_time')).order_by() \
+        .values('month').annotate(count=Count('id')).values_list('month', 'count')
+    counts = {}
+    for month, count in months:
+        month = timezone.localtime(month) if timezone.is_aware(month) else month
+        counts[(month.year, month.month)] = counts.get((month.year, month.month), 0) + count
+    ArchiveMonth.objects.bulk_create(
+        ArchiveMonth(year=year, month=month, count=count) for (year, month), count in counts.items())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blog', '0006_tag_article_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Archive month',
+                'verbose_name_plural': 'Archive months',
+                'ordering': ['-year', '-month'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='archivemonth',
+            unique_together={('year', 'month')},
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['status', 'created_time'], name='blog_art_status_created_idx'),
+        ),
+        migrations.RunPython(build_archive, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_archivemonth'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['pub_time', 'id'], name='blog_art_pub_time_id_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.0 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    Category = apps.get_model('blog', 'Category')
+    parents = dict(Category.objects.values_list('id', 'parent_category_id'))
+    for id in parents:
+        ids = [id]
+        while parents.get(ids[-1]) and parents[ids[-1]] not in ids:
+            ids.append(parents[ids[-1]])
+        path = '/' + ''.join('%d/' % i for i in reversed(ids))
+        Category.objects.filter(id=id).update(path=path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_article_pub_time_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
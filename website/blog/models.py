@@ -1,12 +1,22 @@
+import datetime
+import html
 import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 
 from django.conf import settings
 from django.db import models
-from django.template.defaultfilters import slugify
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Concat, Substr, TruncMonth
+from django.template.defaultfilters import slugify, truncatechars_html, truncatewords
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.functional import cached_property
+from django.utils.html import strip_tags
 
-from website.utils import cache_decorator, cache
+from website.utils import cache, cache_get_tagged, cache_set_tagged, get_md5, CommonMarkdown, \
+    get_markdown_render_version, ProcessSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +45,12 @@ class Article(BaseModel):
     )
     title = models.CharField('Title', max_length=200, unique=True)
     body = models.TextField()
+    body_html = models.TextField(blank=True, editable=False)
+    excerpt_html = models.TextField(blank=True, editable=False)
+    summary = models.TextField(blank=True, editable=False)
+    word_count = models.PositiveIntegerField(default=0, editable=False)
+    body_digest = models.CharField(max_length=32, blank=True, editable=False)
+    render_version = models.CharField(max_length=32, blank=True, editable=False)
     pub_time = models.DateTimeField(blank=True, null=True)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='p')
     comment_status = models.CharField(max_length=1, choices=COMMENT_STATUS, default='o')
@@ -45,6 +61,10 @@ class Article(BaseModel):
     category = models.ForeignKey('Category', on_delete=models.CASCADE, blank=False, null=False)
     tags = models.ManyToManyField('Tag', blank=True)
 
+    RENDER_FIELDS = ('body_html', 'excerpt_html', 'summary', 'word_count', 'body_digest', 'render_version')
+    # cached list entries carry only these author columns, never the password hash or the email
+    LIST_AUTHOR_FIELDS = ('username', 'nickname')
+
     def __str__(self):
         return self.title
 
@@ -53,6 +73,10 @@ class Article(BaseModel):
         verbose_name = "Articles"
         verbose_name_plural = verbose_name
         get_latest_by = 'created_time'
+        indexes = [
+            models.Index(fields=['status', 'created_time'], name='blog_art_status_created_idx'),
+            models.Index(fields=['pub_time', 'id'], name='blog_art_pub_time_id_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('blog:detailbyid', kwargs={
@@ -62,9 +86,8 @@ class Article(BaseModel):
             'day': self.created_time.day
         })
 
-    @cache_decorator(60 * 60 * 10)
     def get_category_tree(self):
-        tree = self.category.get_category_tree()
+        tree = Category.get_tree().get_ancestors(self.category_id)
         names = list(map(lambda c: (c.name, c.get_absolute_url()), tree))
 
         return names
@@ -74,40 +97,317 @@ class Article(BaseModel):
             # Only set the slug when the object is created.
             self.slug = slugify(self.title)
 
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            if self.render_body() and update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + list(Article.RENDER_FIELDS)
+
         super().save(*args, **kwargs)
 
-    def viewed(self):
-        self.views += 1
-        self.save(update_fields=['views'])
+    @staticmethod
+    def get_render_version():
+        # the excerpt and summary depend on their lengths as well as on the renderer
+        return '{renderer}.{length}.{words}'.format(renderer=get_markdown_render_version(),
+                                                    length=settings.ARTICLE_SUB_LENGTH,
+                                                    words=settings.ARTICLE_SUMMARY_WORDS)
+
+    def is_render_stale(self):
+        if self.render_version != Article.get_render_version():
+            return True
+        # list pages defer the body; saves re-render it, so the version is enough there
+        return 'body' not in self.get_deferred_fields() and self.body_digest != get_md5(self.body)
+
+    @staticmethod
+    def render_fields(body, body_html=None):
+        """Values of RENDER_FIELDS for a body; pass body_html to skip the markdown cache."""
+        if body_html is None:
+            body_html = CommonMarkdown.get_cached_markdown(body)
+        # plain text for meta tags; unescaped because templates escape it again
+        text = html.unescape(strip_tags(body_html))
+        return {
+            'body_html': body_html,
+            'excerpt_html': truncatechars_html(body_html, settings.ARTICLE_SUB_LENGTH),
+            'summary': truncatewords(text, settings.ARTICLE_SUMMARY_WORDS),
+            'word_count': len(text.split()),
+            'body_digest': get_md5(body),
+            'render_version': Article.get_render_version(),
+        }
+
+    def render_body(self):
+        """Rebuild the stored html if the body or the renderer changed. Returns True when rebuilt."""
+        if not self.is_render_stale():
+            return False
+        for field, value in Article.render_fields(self.body).items():
+            setattr(self, field, value)
+        return True
+
+    def refresh_render(self):
+        """Rebuild and persist stale html without touching the other columns."""
+        if self.render_body() and self.pk:
+            Article.objects.filter(pk=self.pk).update(**{f: getattr(self, f) for f in Article.RENDER_FIELDS})
+            Article.expire_cached_articles([self.pk])
+
+    def get_body_html(self):
+        self.refresh_render()
+        return self.body_html
+
+    def get_excerpt_html(self):
+        self.refresh_render()
+        return self.excerpt_html
+
+    def get_summary(self):
+        self.refresh_render()
+        return self.summary
+
+    def viewed(self, visitor=None):
+        from blog.counters import view_counter
+        view_counter.record(self.id, visitor)
+
+    def get_view_count(self):
+        """Persisted views plus the ones still buffered in this process."""
+        from blog.counters import view_counter
+        return self.views + view_counter.pending(self.id)
+
+    @staticmethod
+    def get_cache_key(id):
+        return 'article_{id}'.format(id=id)
+
+    @staticmethod
+    def get_list_queryset():
+        """Articles with everything an article list entry renders loaded up front."""
+        fields = [f.name for f in Article._meta.concrete_fields if f.name not in ('body', 'body_html')]
+        return Article.objects.select_related('author', 'category').prefetch_related('tags') \
+            .annotate(comment_count=Count('comment', filter=Q(comment__is_enable=True))) \
+            .only(*fields, *['author__' + f for f in Article.LIST_AUTHOR_FIELDS])
+
+    def get_comment_count(self):
+        if hasattr(self, 'comment_count'):
+            return self.comment_count
+        return self.comment_set.filter(is_enable=True).count()
+
+    @staticmethod
+    def get_cached_articles(ids):
+        """Articles for the given ids in that order, from the per-article cache entries.
+
+        Missing entries are loaded with one query and cached; ids of deleted articles are skipped.
+        """
+        keys = {id: Article.get_cache_key(id) for id in ids}
+        cached = cache.get_many(keys.values())
+        articles = {id: cached[key] for id, key in keys.items() if key in cached}
+        missing = [id for id in ids if id not in articles]
+        if missing:
+            loaded = Article.get_list_queryset().in_bulk(missing)
+            cache.set_many({keys[id]: article for id, article in loaded.items()})
+            articles.update(loaded)
+        return [articles[id] for id in ids if id in articles]
+
+    @staticmethod
+    def expire_cached_articles(ids):
+        cache.delete_many([Article.get_cache_key(id) for id in ids])
 
     def comment_list(self):
         cache_key = 'article_comments_{id}'.format(id=self.id)
-        value = cache.get(cache_key)
-        if value:
+        value, generations = cache_get_tagged(cache_key, ['article:{id}'.format(id=self.id)])
+        if value is not None:
             logger.info('get article comments:{id}'.format(id=self.id))
             return value
         else:
-            comments = self.comment_set.filter(is_enable=True)
-            cache.set(cache_key, comments)
+            comment_model = self.comment_set.model
+            fields = [f.name for f in comment_model._meta.concrete_fields]
+            comments = list(self.comment_set.filter(is_enable=True).select_related('author')
+                            .only(*fields, *['author__' + f for f in comment_model.LIST_AUTHOR_FIELDS]))
+            cache_set_tagged(cache_key, comments, generations)
             logger.info('set article comments:{id}'.format(id=self.id))
             return comments
 
+    def get_cache_tags(self, tag_ids=None):
+        """Dependency tags of every cached list, page and fragment that shows this article."""
+        tags = ['article:{id}'.format(id=self.id), 'author:{id}'.format(id=self.author_id),
+                'archive:{0}-{1:02d}'.format(*self.get_archive_month()), 'sidebar']
+        if self.type == 'a':
+            tags.append('index')
+        # category pages list the articles of their subcategories too
+        tags.extend('category:{id}'.format(id=c.id) for c in Category.get_tree().get_ancestors(self.category_id))
+        if tag_ids is None:
+            tag_ids = self.tags.values_list('id', flat=True) if self.pk else []
+        tags.extend('tag:{id}'.format(id=id) for id in tag_ids)
+        return tags
+
+    def get_archive_month(self):
+        created_time = timezone.localtime(self.created_time)
+        return created_time.year, created_time.month
+
     def get_admin_url(self):
         info = (self._meta.app_label, self._meta.model_name)
         return reverse('admin:%s_%s_change' % info, args=(self.pk,))
 
+    @staticmethod
+    def build_adjacency():
+        links = [ArticleLink(*row) for row in
+                 Article.objects.filter(status='p').order_by('id').values_list('id', 'title', 'created_time')]
+        return ArticleAdjacency(links)
+
     @cached_property
     def next_article(self):
-        return Article.objects.filter(id__gt=self.id, status='p').order_by('id').first()
+        """The published article with the next higher id."""
+        return article_adjacency.get().get_next(self.id)
 
     @cached_property
     def prev_article(self):
-        return Article.objects.filter(id__lt=self.id, status='p').first()
+        """The published article with the next lower id."""
+        return article_adjacency.get().get_previous(self.id)
+
+
+class ArticleLink(namedtuple('ArticleLink', 'id title created_time')):
+    __slots__ = ()
+
+    def get_absolute_url(self):
+        return reverse('blog:detailbyid', kwargs={
+            'article_id': self.id,
+            'year': self.created_time.year,
+            'month': self.created_time.month,
+            'day': self.created_time.day
+        })
+
+    def __str__(self):
+        return self.title
+
+
+class ArticleAdjacency():
+    """Published articles in id order; neighbours are found with a bisect on the id array."""
+
+    def __init__(self, links):
+        self.links = links
+        self.ids = array('l', (link.id for link in links))
+
+    def get_next(self, id):
+        index = bisect_right(self.ids, id)
+        return self.links[index] if index < len(self.links) else None
+
+    def get_previous(self, id):
+        index = bisect_left(self.ids, id)
+        return self.links[index - 1] if index > 0 else None
+
+
+class ArticleViewStat(models.Model):
+    """Views and a HyperLogLog sketch of visitors for one article and day; rows without an article are site-wide."""
+    article = models.ForeignKey(Article, blank=True, null=True, on_delete=models.CASCADE)
+    date = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+    visitors = models.BinaryField()
+
+    class Meta:
+        ordering = ['date']
+        unique_together = (('article', 'date'),)
+        verbose_name = 'Article view stat'
+        verbose_name_plural = 'Article view stats'
+
+    def get_visitor_count(self):
+        from blog.analytics import HyperLogLog
+        return HyperLogLog(bytes(self.visitors)).count()
+
+
+class ArchiveMonth(models.Model):
+    """Number of published articles created in a month, kept current by the signals in website.blog_signals."""
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-year', '-month']
+        unique_together = (('year', 'month'),)
+        verbose_name = 'Archive month'
+        verbose_name_plural = 'Archive months'
+
+    def __str__(self):
+        return '{year}-{month:02d}'.format(year=self.year, month=self.month)
+
+    def get_absolute_url(self):
+        return reverse('blog:archive', kwargs={'year': self.year, 'month': self.month})
+
+    @staticmethod
+    def get_month_range(year, month):
+        start = timezone.make_aware(datetime.datetime(year, month, 1))
+        end = timezone.make_aware(datetime.datetime(year + month // 12, month % 12 + 1, 1))
+        return start, end
+
+    @staticmethod
+    def refresh_months(months=None):
+        """Recount the given (year, month) pairs, or rebuild the whole index."""
+        articles = Article.objects.filter(status='p')
+        if months is not None:
+            months = set(months)
+            if not months:
+                return
+            ranges = models.Q()
+            for year, month in months:
+                start, end = ArchiveMonth.get_month_range(year, month)
+                ranges |= models.Q(created_time__gte=start, created_time__lt=end)
+            articles = articles.filter(ranges)
+        counts = {}
+        for month, count in articles.annotate(month=TruncMonth('created_time')).order_by() \
+                .values('month').annotate(count=Count('id')).values_list('month', 'count'):
+            month = timezone.localtime(month) if timezone.is_aware(month) else month
+            counts[(month.year, month.month)] = count
+        if months is None:
+            ArchiveMonth.objects.all().delete()
+            months = counts
+        for year, month in months:
+            count = counts.get((year, month), 0)
+            if count:
+                ArchiveMonth.objects.update_or_create(year=year, month=month, defaults={'count': count})
+            else:
+                ArchiveMonth.objects.filter(year=year, month=month).delete()
+
+
+class CategoryNode(namedtuple('CategoryNode', 'id name slug parent_id path url')):
+    __slots__ = ()
+
+    def get_absolute_url(self):
+        return self.url
+
+    def __str__(self):
+        return self.name
+
+
+class CategoryTree():
+    """Immutable snapshot of the whole category hierarchy, answering tree questions without queries."""
+
+    def __init__(self, nodes):
+        self.nodes = {node.id: node for node in nodes}
+        self.children = {}
+        for node in nodes:
+            self.children.setdefault(node.parent_id, []).append(node.id)
+
+    def get(self, id):
+        return self.nodes.get(id)
+
+    def get_ancestors(self, id):
+        """The category and its parents up to the root, in that order."""
+        ancestors = []
+        node = self.nodes.get(id)
+        while node is not None and node not in ancestors:
+            ancestors.append(node)
+            node = self.nodes.get(node.parent_id)
+        return ancestors
+
+    def get_descendant_ids(self, id):
+        """Ids of the category and everything below it."""
+        ids = []
+        stack = [id]
+        while stack:
+            id = stack.pop()
+            if id in self.nodes and id not in ids:
+                ids.append(id)
+                stack.extend(self.children.get(id, ()))
+        return ids
 
 
 class Category(BaseModel):
     name = models.CharField(max_length=30, unique=True)
     parent_category = models.ForeignKey('self', blank=True, null=True, on_delete=models.CASCADE)
+    # ids from the root down to this category, like /1/4/9/
+    path = models.CharField(max_length=255, blank=True, db_index=True, editable=False)
 
     class Meta:
         ordering = ['name']
@@ -120,39 +420,45 @@ class Category(BaseModel):
     def __str__(self):
         return self.name
 
-    @cache_decorator(60 * 60 * 10)
-    def get_category_tree(self):
-        categorys = []
-
-        def parse(category):
-            categorys.append(category)
-            if category.parent_category:
-                parse(category.parent_category)
+    def save(self, *args, **kwargs):
+        parent_path = Category.objects.get(pk=self.parent_category_id).path if self.parent_category_id else '/'
+        if self.id and '/{id}/'.format(id=self.id) in parent_path:
+            raise ValueError('category {id} cannot be moved below itself'.format(id=self.id))
+        super().save(*args, **kwargs)
+        path = '{parent}{id}/'.format(parent=parent_path, id=self.id)
+        if path != self.path:
+            old_path = self.path
+            Category.objects.filter(pk=self.pk).update(path=path)
+            if old_path:
+                # move the subtree along
+                Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(models.Value(path), Substr('path', len(old_path) + 1)))
+            self.path = path
+
+    @staticmethod
+    def build_tree():
+        nodes = [CategoryNode(id, name, slug, parent_id, path,
+                              reverse('blog:category_detail', kwargs={'category_name': slug}))
+                 for id, name, slug, parent_id, path in
+                 Category.objects.values_list('id', 'name', 'slug', 'parent_category_id', 'path')]
+        return CategoryTree(nodes)
+
+    @staticmethod
+    def get_tree():
+        return category_tree.get()
 
-        parse(self)
-        return categorys
+    def get_category_tree(self):
+        return Category.get_tree().get_ancestors(self.id)
 
-    @cache_decorator(60 * 60 * 10)
     def get_sub_categorys(self):
-        categorys = []
-        all_categorys = Category.objects.all()
-
-        def parse(category):
-            if category not in categorys:
-                categorys.append(category)
-            childs = all_categorys.filter(parent_category=category)
-            for child in childs:
-                if category not in categorys:
-                    categorys.append(child)
-                parse(child)
-
-        parse(self)
-        return categorys
+        return list(Category.objects.filter(path__startswith=self.path))
 
 
 class Tag(BaseModel):
     """Tag Model"""
     name = models.CharField(max_length=30, unique=True)
+    # published articles with this tag, kept current by the signals in website.blog_signals
+    article_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -160,9 +466,18 @@ class Tag(BaseModel):
     def get_absolute_url(self):
         return reverse('blog:tag_detail', kwargs={'tag_name': self.slug})
 
-    @cache_decorator(60 * 60 * 10)
     def get_article_count(self):
-        return Article.objects.filter(tags__name=self.name).distinct().count()
+        return self.article_count
+
+    @staticmethod
+    def refresh_article_counts(tag_ids=None):
+        """Recount published articles for the given tags, or for all tags, in one UPDATE."""
+        published = Article.tags.through.objects.filter(tag_id=OuterRef('pk'), article__status='p') \
+            .order_by().values('tag_id').annotate(count=Count('article_id', distinct=True)).values('count')
+        tags = Tag.objects.all()
+        if tag_ids is not None:
+            tags = tags.filter(id__in=list(tag_ids))
+        tags.update(article_count=Coalesce(Subquery(published, output_field=models.IntegerField()), 0))
 
     class Meta:
         ordering = ['name']
@@ -201,3 +516,7 @@ class SideBar(models.Model):
 
     def __str__(self):
         return self.name
+
+
+category_tree = ProcessSnapshot('category_tree', Category.build_tree)
+article_adjacency = ProcessSnapshot('article_adjacency', Article.build_adjacency)
@@ -0,0 +1,137 @@
+import base64
+import json
+from collections.abc import Sequence
+
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+
+# newest first; articles without pub_time go last, in id order like the rest
+KEYSET_ORDERING = (F('pub_time').desc(nulls_last=True), F('id').desc())
+REVERSE_KEYSET_ORDERING = (F('pub_time').asc(nulls_first=True), F('id').asc())
+
+
+def get_article_key(article):
+    return article.pub_time, article.id
+
+
+def dump_key(key):
+    pub_time, id = key
+    return [pub_time.isoformat() if pub_time else None, id]
+
+
+def load_key(value):
+    pub_time, id = value
+    return parse_datetime(pub_time) if pub_time else None, int(id)
+
+
+def encode_cursor(key, page_number, direction):
+    """An opaque cursor for the page starting after (direction 'n') or ending before ('p') key."""
+    value = json.dumps({'k': dump_key(key), 'p': page_number, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (key, page_number, direction); raises ValueError for a malformed cursor."""
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        key, page_number, direction = load_key(value['k']), int(value['p']), value['d']
+    except Exception as e:
+        raise ValueError('invalid cursor: %s' % e)
+    if direction not in ('n', 'p') or page_number < 1:
+        raise ValueError('invalid cursor')
+    return key, page_number, direction
+
+
+def after_key(key):
+    """Articles ranked after key in KEYSET_ORDERING."""
+    pub_time, id = key
+    if pub_time is None:
+        return Q(pub_time__isnull=True, id__lt=id)
+    return Q(pub_time__lt=pub_time) | Q(pub_time=pub_time, id__lt=id) | Q(pub_time__isnull=True)
+
+
+def before_key(key):
+    """Articles ranked before key in KEYSET_ORDERING."""
+    pub_time, id = key
+    if pub_time is None:
+        return Q(pub_time__isnull=False) | Q(pub_time__isnull=True, id__gt=id)
+    return Q(pub_time__gt=pub_time) | Q(pub_time=pub_time, id__gt=id)
+
+
+class KeysetPage(Sequence):
+    """A page of a keyset paginated list, with the page interface the templates use."""
+
+    def __init__(self, object_list, number, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.number = number
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<Page %s>' % self.number
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+class KeysetPaginator():
+    """Pages through a queryset in KEYSET_ORDERING by seeking past the edge of the previous page.
+
+    No COUNT query is made and deep pages cost the same as the first one.
+    """
+
+    def __init__(self, object_list, per_page):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+
+    def slice(self, key=None, direction='n', offset=0):
+        """Returns (rows, has_more) for the page after or before key, or at offset when there is no key."""
+        queryset = self.object_list
+        if key is None:
+            queryset = queryset.order_by(*KEYSET_ORDERING)[offset:offset + self.per_page + 1]
+        elif direction == 'n':
+            queryset = queryset.filter(after_key(key)).order_by(*KEYSET_ORDERING)[:self.per_page + 1]
+        else:
+            queryset = queryset.filter(before_key(key)).order_by(*REVERSE_KEYSET_ORDERING)[:self.per_page + 1]
+        rows = list(queryset)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == 'p':
+            rows.reverse()
+        return rows, has_more
+
+    def page(self, number, key=None, direction='n'):
+        """The page after or before key; without a key, page number is read with an OFFSET."""
+        if key is None:
+            rows, has_next = self.slice(offset=(number - 1) * self.per_page)
+            has_previous = number > 1
+        elif direction == 'n':
+            rows, has_next = self.slice(key, 'n')
+            has_previous = True
+        else:
+            rows, has_previous = self.slice(key, 'p')
+            has_next = True
+        if not rows:
+            return KeysetPage(rows, number)
+        # page numbers only label the pages; the cursors carry the position
+        return KeysetPage(rows, number,
+                          encode_cursor(get_article_key(rows[-1]), number + 1, 'n') if has_next else None,
+                          encode_cursor(get_article_key(rows[0]), max(number - 1, 1), 'p') if has_previous else None)
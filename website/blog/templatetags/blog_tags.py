@@ -3,18 +3,28 @@ import urllib
 
 from django import template
 from django.conf import settings
-from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import stringfilter, random
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
-from blog.models import Category, Tag, Article, SideBar, Links
+from blog.counters import most_read_index
+from blog.directory import resolve_name
+from blog.models import Category, Tag, Article, SideBar, Links, ArchiveMonth
+from blog.pagination import KeysetPage
 from comments.models import Comment
 from oauth.models import OAuthUser
+from website.utils import get_cache_tag_generations
 
 register = template.Library()
 
 
+@register.simple_tag
+def cache_generation(*tags):
+    """Current generations of dependency tags, to vary a {% cache %} fragment on."""
+    generations = get_cache_tag_generations(tags)
+    return '.'.join(str(generations[tag]) for tag in tags)
+
+
 @register.simple_tag
 def timeformat(data):
     try:
@@ -35,7 +45,7 @@ def datetimeformat(data):
 @stringfilter
 def custom_markdown(content):
     from website.utils import CommonMarkdown
-    return mark_safe(CommonMarkdown.get_markdown(content))
+    return mark_safe(CommonMarkdown.get_cached_markdown(content))
 
 
 @register.filter(is_safe=True)
@@ -83,14 +93,17 @@ def load_articletags(article):
 
 
 @register.inclusion_tag('blog/tags/sidebar.html')
-def load_sidebar(user):
+def load_sidebar():
     recent_articles = Article.objects.filter(status='p')[:settings.SIDEBAR_ARTICLE_COUNT]
     sidebar_categorys = Category.objects.all()
     extra_sidebars = SideBar.objects.filter(is_enable=True).order_by('sequence')
-    most_read_articles = Article.objects.filter(status='p').order_by('-views')[:settings.SIDEBAR_ARTICLE_COUNT]
-    dates = Article.objects.datetimes('created_time', 'month', order='DESC')
+    most_read_ids = most_read_index.get_ids()
+    most_read_map = Article.objects.in_bulk(most_read_ids)
+    most_read_articles = [most_read_map[id] for id in most_read_ids if id in most_read_map]
+    archive_months = ArchiveMonth.objects.all()
     links = Links.objects.all()
-    commment_list = Comment.objects.filter(is_enable=True).order_by('-id')[:settings.SIDEBAR_COMMENT_COUNT]
+    commment_list = Comment.objects.filter(is_enable=True).select_related('author', 'article') \
+        .order_by('-id')[:settings.SIDEBAR_COMMENT_COUNT]
     show_adsense = settings.SHOW_GOOGLE_ADSENSE
     increment = 5
     tags = Tag.objects.all()
@@ -105,16 +118,22 @@ def load_sidebar(user):
         'recent_articles': recent_articles,
         'sidebar_categorys': sidebar_categorys,
         'most_read_articles': most_read_articles,
-        'article_dates': dates,
+        'archive_months': archive_months,
         'sidabar_links': links,
         'sidebar_comments': commment_list,
-        'user': user,
         'show_adsense': show_adsense,
         'sidebar_tags': sidebar_tags,
         'extra_sidebars': extra_sidebars
     }
 
 
+@register.inclusion_tag('blog/tags/sidebar_features.html')
+def load_sidebar_features(user):
+    return {
+        'user': user
+    }
+
+
 @register.inclusion_tag('blog/tags/article_meta_info.html')
 def load_article_metas(article, user):
     return {
@@ -123,10 +142,21 @@ def load_article_metas(article, user):
     }
 
 
-@register.inclusion_tag('blog/tags/article_pagination.html')
-def load_pagination_info(page_obj, page_type, tag_name):
+@register.inclusion_tag('blog/tags/article_pagination.html', takes_context=True)
+def load_pagination_info(context, page_obj, page_type, tag_name):
     previous_url = ''
     next_url = ''
+    if isinstance(page_obj, KeysetPage):
+        path = context['request'].path
+        if page_obj.has_next():
+            next_url = '{path}?cursor={cursor}'.format(path=path, cursor=page_obj.next_cursor)
+        if page_obj.has_previous():
+            previous_url = '{path}?cursor={cursor}'.format(path=path, cursor=page_obj.previous_cursor)
+        return {
+            'previous_url': previous_url,
+            'next_url': next_url,
+            'page_obj': page_obj
+        }
     if page_type == '':
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
@@ -135,11 +165,11 @@ def load_pagination_info(page_obj, page_type, tag_name):
             previous_number = page_obj.previous_page_number()
             previous_url = reverse('blog:index_page', kwargs={'page': previous_number})
     if page_type == 'tags':
-        tag = get_object_or_404(Tag, name=tag_name)
-        if page_obj.has_next():
+        tag = resolve_name('tag', tag_name)
+        if tag and page_obj.has_next():
             next_number = page_obj.next_page_number()
             next_url = reverse('blog:tag_detail_page', kwargs={'page': next_number, 'tag_name': tag.slug})
-        if page_obj.has_previous():
+        if tag and page_obj.has_previous():
             previous_number = page_obj.previous_page_number()
             previous_url = reverse('blog:tag_detail_page', kwargs={'page': previous_number, 'tag_name': tag.slug})
     if page_type == 'author':
@@ -150,13 +180,22 @@ def load_pagination_info(page_obj, page_type, tag_name):
             previous_number = page_obj.previous_page_number()
             previous_url = reverse('blog:author_detail_page', kwargs={'page': previous_number, 'author_name': tag_name})
 
-    if page_type == 'Archive':
-        category = get_object_or_404(Category, name=tag_name)
+    if page_type == 'Monthly archive':
+        year, month = map(int, tag_name.split('-'))
         if page_obj.has_next():
+            next_url = reverse('blog:archive_page',
+                               kwargs={'year': year, 'month': month, 'page': page_obj.next_page_number()})
+        if page_obj.has_previous():
+            previous_url = reverse('blog:archive_page',
+                                   kwargs={'year': year, 'month': month, 'page': page_obj.previous_page_number()})
+
+    if page_type == 'Archive':
+        category = resolve_name('category', tag_name)
+        if category and page_obj.has_next():
             next_number = page_obj.next_page_number()
             next_url = reverse('blog:category_detail_page',
                                kwargs={'page': next_number, 'category_name': category.slug})
-        if page_obj.has_previous():
+        if category and page_obj.has_previous():
             previous_number = page_obj.previous_page_number()
             previous_url = reverse('blog:category_detail_page',
                                    kwargs={'page': previous_number, 'category_name': category.slug})
@@ -180,28 +219,38 @@ def load_nav_info():
 
 @register.inclusion_tag('blog/tags/article_info.html')
 def load_article_detail(article, isindex, user):
+    content = article.get_excerpt_html() if isindex else article.get_body_html()
     return {
         'article': article,
+        'content': mark_safe(content),
         'isindex': isindex,
         'user': user
     }
 
 
+def get_gravatar_url(digest, size=40):
+    default = "https://resource.lylinux.net/image/2017/03/26/120117.jpg".encode('utf-8')
+
+    return "https://www.gravatar.com/avatar/%s?%s" % (digest, urllib.parse.urlencode({'d': default, 's': str(size)}))
+
+
 # return only the URL of the gravatar
 # TEMPLATE USE:  {{ email|gravatar_url:150 }}
 @register.filter
 def gravatar_url(email, size=40):
-    usermodels = OAuthUser.objects.filter(email=email)
-    if usermodels:
-        o = list(filter(lambda x: x.picture is not None, usermodels))
-        if o:
-            return o[0].picture
+    picture = OAuthUser.get_pictures([email]).get(email)
+    if picture:
+        return picture
     email = email.encode('utf-8')
+    return get_gravatar_url(hashlib.md5(email.lower()).hexdigest(), size)
 
-    default = "https://resource.lylinux.net/image/2017/03/26/120117.jpg".encode('utf-8')
 
-    return "https://www.gravatar.com/avatar/%s?%s" % (
-        hashlib.md5(email.lower()).hexdigest(), urllib.parse.urlencode({'d': default, 's': str(size)}))
+# the URL of an avatar from BlogUser.get_avatars
+# TEMPLATE USE:  {{ avatar|avatar_url:150 }}
+@register.filter
+def avatar_url(avatar, size=40):
+    picture, digest = avatar or ('', '')
+    return picture or get_gravatar_url(digest, size)
 
 
 # return an image tag with the gravatar
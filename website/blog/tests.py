@@ -1 +1,616 @@
-# Create your tests here.
+import base64
+import json
+import pickle
+import socketserver
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import MemcachedCache
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import BlogUser
+from blog.analytics import DailyViewStats
+from blog.counters import MostReadIndex, ViewCounter
+from blog.models import Article, ArchiveMonth, ArticleViewStat, Category, Tag, category_tree
+from blog.pagination import KEYSET_ORDERING, KeysetPage
+from comments.models import Comment
+from oauth.models import OAuthUser
+from website.cache_backends import CircuitBreakerCache, _tiers
+from website.middleware import QueryBudgetExceeded
+from website.utils import CommonMarkdown, ProcessSnapshot, get_cache_tag_generations, invalidate_cache_tags, \
+    load_site_domain, site_domain, split_markdown_blocks
+
+# the production layering, with an in-process store where memcached would be
+TEST_CACHES = dict(settings.CACHES, memcached={
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'blog-tests',
+})
+
+
+@override_settings(CACHES=TEST_CACHES, VIEW_COUNT_FLUSH_INTERVAL=3600, VIEW_COUNT_FLUSH_THRESHOLD=10000)
+class BlogTestCase(TestCase):
+    """A small blog: 25 articles in a subcategory, 3 tags on each, and a comment thread per article."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = BlogUser.objects.create_user('author', 'author@example.com', 'password')
+        cls.parent_category = Category.objects.create(name='parent', slug='parent')
+        cls.category = Category.objects.create(name='child', slug='child', parent_category=cls.parent_category)
+        cls.tags = [Tag.objects.create(name='tag%d' % i, slug='tag%d' % i) for i in range(3)]
+        for i in range(25):
+            article = Article.objects.create(title='article %d' % i, body='body of *article %d*' % i,
+                                             author=cls.author, category=cls.category)
+            article.tags.add(*cls.tags)
+            for j in range(3):
+                comment = Comment.objects.create(body='comment %d' % j, author=cls.author, article=article)
+                Comment.objects.create(body='reply %d' % j, author=cls.author, article=article,
+                                       parent_comment=comment)
+        cls.article = article
+
+    def setUp(self):
+        cache.clear()
+
+    def get_list_urls(self):
+        month = ArchiveMonth.objects.get()
+        return [
+            reverse('blog:index'),
+            reverse('blog:category_detail', kwargs={'category_name': self.parent_category.slug}),
+            reverse('blog:tag_detail', kwargs={'tag_name': self.tags[0].slug}),
+            reverse('blog:author_detail', kwargs={'author_name': self.author.username}),
+            reverse('blog:archive', kwargs={'year': month.year, 'month': month.month}),
+        ]
+
+
+@override_settings(QUERY_BUDGET_RAISE=True)
+class QueryBudgetTest(BlogTestCase):
+    def test_cold_pages_stay_within_budget(self):
+        for url in self.get_list_urls() + [self.article.get_absolute_url()]:
+            with self.subTest(url=url):
+                # QueryBudgetMiddleware raises when the page runs more queries than its budget
+                cache.clear()
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                budget = settings.QUERY_BUDGETS[response.resolver_match.view_name]
+                self.assertLessEqual(int(response['X-Query-Count']), budget)
+
+    def test_warm_pages_skip_the_database(self):
+        for url in self.get_list_urls():
+            with self.subTest(url=url):
+                self.client.get(url)
+                response = self.client.get(url)
+                self.assertLessEqual(int(response['X-Query-Count']), 1)
+
+    @override_settings(QUERY_BUDGET_RAISE=False)
+    def test_logged_in_request(self):
+        # the lazy request.user is loaded while the queries are traced; budgets are for anonymous pages
+        self.client.force_login(self.author)
+        self.assertEqual(self.client.get(self.article.get_absolute_url()).status_code, 200)
+
+    def test_exceeding_the_budget_fails(self):
+        with override_settings(QUERY_BUDGETS=dict(settings.QUERY_BUDGETS, **{'blog:index': 1})):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse('blog:index'))
+
+
+class ListQueryCountTest(BlogTestCase):
+    def assertListQueries(self, url, cache_tags):
+        for page_size in (5, 20):
+            with self.subTest(page_size=page_size), override_settings(PAGINATE_BY=page_size):
+                # warm the shared sidebar and the slug directory, then drop only what the list cached
+                self.client.get(url)
+                invalidate_cache_tags(*cache_tags)
+                Article.expire_cached_articles(Article.objects.values_list('id', flat=True))
+                # count, page ids, articles with author, category and comment count, their tags
+                with self.assertNumQueries(4):
+                    response = self.client.get(url)
+                self.assertEqual(len(response.context['article_list']), page_size)
+
+    def test_index(self):
+        self.assertListQueries(reverse('blog:index'), ['index'])
+
+    def test_tag_detail(self):
+        tag = self.tags[0]
+        self.assertListQueries(reverse('blog:tag_detail', kwargs={'tag_name': tag.slug}),
+                               ['tag:{id}'.format(id=tag.id)])
+
+
+class CachedDataTest(BlogTestCase):
+    """Cached model instances must not carry private user columns into memcached."""
+
+    def assertNoPrivateFields(self, user):
+        self.assertTrue({'password', 'email'} <= user.get_deferred_fields())
+        self.assertNotIn(self.author.password.encode(), pickle.dumps(user))
+
+    def test_cached_articles(self):
+        Article.get_cached_articles([self.article.id])
+        article = Article.get_cached_articles([self.article.id])[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(article.author.username, 'author')
+        self.assertNoPrivateFields(article.author)
+
+    def test_cached_comments(self):
+        self.article.comment_list()
+        comments = self.article.comment_list()
+        with self.assertNumQueries(0):
+            self.assertEqual({c.author.username for c in comments}, {'author'})
+        for comment in comments:
+            self.assertNoPrivateFields(comment.author)
+
+    def test_comment_avatars_looked_up_once(self):
+        reader = BlogUser.objects.create_user('reader', 'reader@example.com', 'password')
+        Comment.objects.create(body='a reader comment', author=reader, article=self.article)
+        OAuthUser.objects.create(email=reader.email, picture='https://example.com/reader.png', type='github')
+        with mock.patch.object(BlogUser, 'get_avatars', wraps=BlogUser.get_avatars) as get_avatars, \
+                mock.patch.object(OAuthUser, 'get_pictures') as get_pictures:
+            response = self.client.get(self.article.get_absolute_url())
+        self.assertEqual(get_avatars.call_count, 1)
+        get_pictures.assert_not_called()
+        self.assertContains(response, 'src="https://example.com/reader.png"')
+        self.assertContains(response, 'https://www.gravatar.com/avatar/', count=2 * 6)
+
+
+@override_settings(KEYSET_PAGINATION=True, PAGINATE_BY=5)
+class KeysetPaginationTest(BlogTestCase):
+    def get_ids(self):
+        return list(Article.objects.filter(type='a', status='p').order_by(*KEYSET_ORDERING)
+                    .values_list('id', flat=True))
+
+    def walk(self, url, cursor_attr):
+        """Follow the next or previous cursors from url; returns the pages as id lists and the last url."""
+        pages = []
+        while True:
+            response = self.client.get(url)
+            page = response.context['page_obj']
+            self.assertIsInstance(page, KeysetPage)
+            pages.append([article.id for article in page])
+            cursor = getattr(page, cursor_attr)
+            if not cursor:
+                return pages, url
+            url = '{path}?cursor={cursor}'.format(path=reverse('blog:index'), cursor=cursor)
+            # the pagination links carry the same cursor
+            self.assertContains(response, 'href="{url}"'.format(url=url))
+
+    def assertRoundTrip(self):
+        pages, last_url = self.walk(reverse('blog:index'), 'next_cursor')
+        self.assertEqual([id for page in pages for id in page], self.get_ids())
+        self.assertEqual([len(page) for page in pages], [5] * 5)
+        back, _ = self.walk(last_url, 'previous_cursor')
+        self.assertEqual(back, list(reversed(pages)))
+        return pages
+
+    def test_round_trip(self):
+        self.assertRoundTrip()
+
+    def test_ties_on_the_sort_key(self):
+        ids = self.get_ids()
+        Article.objects.update(pub_time=timezone.now())
+        Article.objects.filter(id__in=ids[-7:]).update(pub_time=None)
+        pages = self.assertRoundTrip()
+        self.assertEqual(len(set(id for page in pages for id in page)), 25)
+
+    def test_page_numbers_use_the_page_map(self):
+        pages = self.assertRoundTrip()
+        for number, page in enumerate(pages, 1):
+            with self.subTest(page=number):
+                response = self.client.get(reverse('blog:index_page', kwargs={'page': number}))
+                self.assertEqual([article.id for article in response.context['page_obj']], page)
+
+    def test_invalid_cursor(self):
+        def encode(value):
+            return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+        cursors = ['garbage', '!!!', encode('not a dict'), encode({'k': [None, 1], 'p': 1}),
+                   encode({'k': ['2020-13-45T00:00:00', 1], 'p': 2, 'd': 'n'}),
+                   encode({'k': [None, 'x'], 'p': 2, 'd': 'n'}), encode({'k': [None, 1], 'p': 0, 'd': 'n'}),
+                   encode({'k': [None, 1, 2], 'p': 2, 'd': 'n'}), encode({'k': [None, 1], 'p': 2, 'd': 'x'})]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get(reverse('blog:index'), {'cursor': cursor}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('blog:index'), {'page': 'abc'}).status_code, 404)
+        # an empty cursor is the first page
+        self.assertEqual(self.client.get(reverse('blog:index'), {'cursor': ''}).status_code, 200)
+
+    def test_setting_is_read_per_request(self):
+        with self.settings(KEYSET_PAGINATION=False):
+            response = self.client.get(reverse('blog:index'))
+        self.assertNotIsInstance(response.context['page_obj'], KeysetPage)
+        self.assertContains(response, 'href="{url}"'.format(url=reverse('blog:index_page', kwargs={'page': 2})))
+
+
+class ClearCacheAdminTest(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('admin:blog_article_clear_cache')
+        self.admin = BlogUser.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def test_clear_whole_cache(self):
+        self.client.force_login(self.admin)
+        self.assertContains(self.client.get(reverse('admin:blog_article_changelist')), 'action="%s"' % self.url)
+        cache.set('snapshot_test', 1)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        self.assertRedirects(self.client.post(self.url), reverse('admin:blog_article_changelist'))
+        self.assertIsNone(cache.get('snapshot_test'))
+
+    def test_superusers_only(self):
+        staff = BlogUser.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+        self.client.force_login(staff)
+        cache.set('snapshot_test', 1)
+        self.assertEqual(self.client.post(self.url).status_code, 403)
+        self.assertEqual(cache.get('snapshot_test'), 1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CommitInvalidationTest(TransactionTestCase):
+    """Cached data is expired when a change commits, not when it is saved inside the transaction."""
+
+    def setUp(self):
+        cache.clear()
+        author = BlogUser.objects.create_user('author', 'author@example.com', 'password')
+        self.category = Category.objects.create(name='category', slug='category')
+        self.article = Article.objects.create(title='title', body='body', author=author, category=self.category)
+
+    def test_article_save(self):
+        self.client.get(reverse('blog:index'))
+        generations = get_cache_tag_generations(['index', 'article:{id}'.format(id=self.article.id)])
+        with transaction.atomic():
+            self.article.title = 'edited'
+            self.article.save()
+            # a request served now would still read the old row from another connection
+            self.assertEqual(get_cache_tag_generations(generations.keys()), generations)
+            self.assertIsNotNone(cache.get(Article.get_cache_key(self.article.id)))
+        self.assertNotEqual(get_cache_tag_generations(generations.keys()), generations)
+        self.assertIsNone(cache.get(Article.get_cache_key(self.article.id)))
+        self.assertContains(self.client.get(reverse('blog:index')), 'edited')
+
+    def test_category_save(self):
+        stamp = category_tree.get_stamp()
+        with transaction.atomic():
+            Category.objects.create(name='subcategory', parent_category=self.category)
+            self.assertEqual(category_tree.get_stamp(), stamp)
+        self.assertNotEqual(category_tree.get_stamp(), stamp)
+        self.assertEqual(len(Category.get_tree().get_descendant_ids(self.category.id)), 2)
+
+    def test_rerender_articles(self):
+        Comment.objects.create(body='first comment', author=self.article.author, article=self.article)
+        Article.get_cached_articles([self.article.id])
+        self.article.comment_list()
+        # what a renderer upgrade looks like: the stored html is outdated but the version is not
+        Article.objects.filter(pk=self.article.pk).update(excerpt_html='old')
+        Comment.objects.update(body_html='old')
+        Article.expire_cached_articles([self.article.id])
+        invalidate_cache_tags('article:{id}'.format(id=self.article.id))
+        Article.get_cached_articles([self.article.id])
+        self.assertEqual([c.body_html for c in self.article.comment_list()], ['old'])
+
+        call_command('rerender_articles', '--all', '--workers', '2', stdout=StringIO())
+        self.assertEqual(Article.get_cached_articles([self.article.id])[0].excerpt_html, '<p>body</p>\n')
+        self.assertEqual([c.body_html for c in self.article.comment_list()], ['<p>first comment</p>\n'])
+
+    def test_site_domain_change(self):
+        # the same snapshot in another worker, which did not handle the save
+        other_worker = ProcessSnapshot('site_domain', load_site_domain)
+        self.assertEqual(other_worker.get(), 'example.com')
+        link = '[home](https://blog.example.org/)'
+        self.assertIn('nofollow', CommonMarkdown.get_cached_markdown(link))
+        site = Site.objects.get_current()
+        site.domain = 'blog.example.org'
+        site.save()
+        self.assertEqual(other_worker.get(), 'blog.example.org')
+        self.assertNotIn('nofollow', CommonMarkdown.get_cached_markdown(link))
+        self.assertTrue(Article.objects.get(pk=self.article.pk).is_render_stale())
+
+    def test_rollback(self):
+        generations = get_cache_tag_generations(['index'])
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.article.save()
+            raise ValueError()
+        self.assertEqual(get_cache_tag_generations(['index']), generations)
+
+
+@override_settings(CACHES=TEST_CACHES, VIEW_COUNT_FLUSH_INTERVAL=0.1, VIEW_COUNT_FLUSH_THRESHOLD=10000)
+class ViewCounterTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        author = BlogUser.objects.create_user('author', 'author@example.com', 'password')
+        category = Category.objects.create(name='category', slug='category')
+        self.article = Article.objects.create(title='title', body='body', author=author, category=category)
+        # views recorded by earlier tests are for articles that were rolled back
+        patcher = mock.patch('blog.counters.daily_view_stats', DailyViewStats())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.counter = ViewCounter()
+        self.addCleanup(self.counter.stop)
+
+    def test_idle_worker_flushes(self):
+        with mock.patch.object(self.counter, 'flush', wraps=self.counter.flush) as flush:
+            self.counter.record(self.article.id)
+            # the view that was recorded does not flush, the worker's thread does
+            flush.assert_not_called()
+            deadline = time.monotonic() + 5
+            while Article.objects.get(pk=self.article.pk).views == 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self.assertEqual(Article.objects.get(pk=self.article.pk).views, 1)
+        self.assertEqual(self.counter.pending(self.article.id), 0)
+
+
+class DailyViewStatsTest(BlogTestCase):
+    def record(self, stats, visitors):
+        for visitor in visitors:
+            stats.record(self.article.id, visitor)
+
+    def test_flush_merges_into_a_row_created_concurrently(self):
+        first, second = DailyViewStats(), DailyViewStats()
+        self.record(first, ['a', 'b'])
+        self.record(second, ['b', 'c', 'c'])
+        first.flush()
+        real_first = QuerySet.first
+        lookups = []
+
+        def first_misses_once(queryset):
+            # the row was not there yet when the second worker looked it up
+            lookups.append(queryset)
+            return None if len(lookups) == 1 else real_first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', autospec=True, side_effect=first_misses_once):
+            second.flush()
+
+        row = ArticleViewStat.objects.get(article=self.article, date=timezone.localdate())
+        self.assertEqual(row.views, 5)
+        self.assertEqual(row.get_visitor_count(), 3)
+        self.assertEqual(sum(ArticleViewStat.objects.filter(article=None).values_list('views', flat=True)), 5)
+        self.assertEqual(second._pending, {})
+
+    def test_failed_flush_keeps_the_views(self):
+        stats = DailyViewStats()
+        self.record(stats, ['a', 'b'])
+        with mock.patch.object(DailyViewStats, 'flush_row', side_effect=RuntimeError('database is down')):
+            stats.flush()
+        self.assertFalse(ArticleViewStat.objects.exists())
+        self.record(stats, ['c'])
+        stats.flush()
+        row = ArticleViewStat.objects.get(article=self.article)
+        self.assertEqual((row.views, row.get_visitor_count()), (3, 3))
+
+
+class MostReadIndexTest(BlogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = MostReadIndex(3)
+        self.index.get()
+        self.article.views = 1000
+        self.article.save(update_fields=['views'])
+
+    def test_update_waits_for_the_lock(self):
+        cache.add(self.index.lock_key, 1)
+        # another worker finishes its update shortly
+        threading.Timer(0.2, cache.delete, [self.index.lock_key]).start()
+        started = time.monotonic()
+        self.index.update_articles([self.article.id])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.index.get_ids()[0], self.article.id)
+        self.assertTrue(cache.add(self.index.lock_key, 1))
+
+    def test_update_rebuilds_when_the_lock_is_stuck(self):
+        cache.add(self.index.lock_key, 1)
+        self.index.lock_wait = 0.1
+        self.index.update_articles([self.article.id])
+        self.assertEqual(self.index.get_ids()[0], self.article.id)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TieredCacheTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_l1_keys(self):
+        self.assertTrue(cache.in_l1('index_1'))
+        self.assertTrue(cache.in_l1('index_keyset_1'))
+        self.assertFalse(cache.in_l1('index_12'))
+        self.assertFalse(cache.in_l1('index_keyset_10'))
+        self.assertTrue(cache.in_l1('snapshot_category_tree'))
+
+    def test_view_flush_keeps_l1(self):
+        cache.set('index_1', 'page')
+        stamp = cache.tier.stamp
+        cache.set(MostReadIndex.cache_key, {'entries': [], 'floor': None})
+        self.assertEqual(cache.tier.stamp, stamp)
+        self.assertEqual(cache.l1.get(cache.get_l1_key('index_1', None)), 'page')
+
+
+MARKDOWN_BLOCKS = [
+    'A paragraph with *emphasis*, `code` and a [link](https://example.com/page "title").',
+    'Setext heading\n==============',
+    'Another one\n-----------',
+    '# ATX heading',
+    '- first item\n- second item\n  continued\n\n- loose item\n    - nested item',
+    '1. one\n2. two\n3. three',
+    '```python\ndef f(x):\n    return x * 2\n```',
+    '```\nplain fence\n\nwith a blank line\n```',
+    '    indented code\n    more code',
+    '> a quote\n> on two lines\n>\n> - with a list',
+    '| name | value |\n| --- | ---: |\n| a | 1 |\n| b | 2 |',
+    'name | value\n--- | ---\nc | 3',
+    '<div class="note">raw html</div>',
+    '***',
+    'Text right before a list\n- which may join it',
+    'Text right before a heading\n---',
+    'A line\nthat wraps\ninto one paragraph.',
+]
+
+
+@override_settings(CACHES=TEST_CACHES, MARKDOWN_INCREMENTAL_MIN_LENGTH=0)
+class IncrementalMarkdownTest(TestCase):
+    """Block by block rendering must give the same html as rendering the whole document."""
+
+    def setUp(self):
+        cache.clear()
+
+    def get_corpus(self):
+        blocks = MARKDOWN_BLOCKS
+        documents = ['\n\n'.join(blocks), '\n'.join(blocks), '\n\n'.join(reversed(blocks))]
+        # every block next to every other, with and without a blank line between them
+        for first in blocks:
+            for second in blocks:
+                documents.append('{0}\n\n{1}'.format(first, second))
+                documents.append('{0}\n{1}'.format(first, second))
+        return documents
+
+    def test_cached_block_needs_the_same_tokens(self):
+        document = 'A paragraph\n\n# A heading'
+        self.assertIsNotNone(CommonMarkdown.get_incremental_markdown(document))
+        blocks = split_markdown_blocks(document)
+        # the same source lexed differently because of its neighbours, as in a list continuation
+        joined = [([{'type': 'text', 'text': 'A paragraph'}], blocks[0][1])] + blocks[1:]
+        calls = []
+
+        def split(value):
+            calls.append(value)
+            return joined if len(calls) == 1 else split_markdown_blocks(value)
+
+        with mock.patch('website.utils.split_markdown_blocks', side_effect=split):
+            self.assertIsNone(CommonMarkdown.get_incremental_markdown(document))
+
+    def test_site_domain_looked_up_once(self):
+        links = '[link {0}](https://example.com/{0}) <https://other.example.org/{0}>'
+        document = '\n\n'.join(links.format(i) for i in range(50))
+        with mock.patch.object(site_domain, 'get', wraps=site_domain.get) as get:
+            html = CommonMarkdown.get_cached_markdown(document)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(html.count('nofollow'), 50)
+
+    def test_matches_full_render(self):
+        corpus = self.get_corpus()
+        rendered = 0
+        for document in corpus:
+            with self.subTest(document=document):
+                html = CommonMarkdown.get_incremental_markdown(document)
+                if html is not None:
+                    rendered += 1
+                    self.assertEqual(html, CommonMarkdown.get_markdown(document))
+        # the rest are rendered whole by get_cached_markdown
+        self.assertGreater(rendered, len(corpus) // 2)
+
+    def test_matches_after_an_edit(self):
+        # an indented code block followed by blank lines lexes differently alone, which renders whole
+        blocks = [block for block in MARKDOWN_BLOCKS if not block.startswith('    ')]
+        CommonMarkdown.get_incremental_markdown('\n\n'.join(blocks))
+        blocks[4] = '- first item\n- an edited item'
+        document = '\n\n'.join(blocks)
+        html = CommonMarkdown.get_incremental_markdown(document)
+        self.assertIsNotNone(html)
+        self.assertEqual(html, CommonMarkdown.get_markdown(document))
+
+    def test_reference_links_render_whole(self):
+        document = 'See [the docs][docs].\n\n[docs]: https://example.com/docs'
+        self.assertIsNone(CommonMarkdown.get_incremental_markdown(document))
+        self.assertEqual(CommonMarkdown.get_cached_markdown(document), CommonMarkdown.get_markdown(document))
+
+
+SLOW_MEMCACHED_REPLIES = {
+    b'get': b'END\r\n',
+    b'set': b'STORED\r\n',
+    b'add': b'STORED\r\n',
+    b'delete': b'NOT_FOUND\r\n',
+    b'incr': b'NOT_FOUND\r\n',
+    b'decr': b'NOT_FOUND\r\n',
+}
+
+
+class SlowMemcachedHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough of the memcached text protocol, answering every command late."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split()[0] if line.split() else b''
+            if command in (b'set', b'add', b'replace', b'cas'):
+                # the data block
+                self.rfile.readline()
+            time.sleep(self.server.delay)
+            try:
+                self.wfile.write(SLOW_MEMCACHED_REPLIES.get(command, b'ERROR\r\n'))
+            except OSError:
+                # the client gave up waiting
+                return
+
+
+class SlowMemcachedServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CircuitBreakerCacheTest(SimpleTestCase):
+    """The production cache options against a memcached that answers late."""
+
+    def get_guarded_cache(self, backend, name, **options):
+        class GuardedCache(CircuitBreakerCache):
+            pass
+
+        GuardedCache.backend = backend
+        guarded = GuardedCache(name, {'OPTIONS': dict(settings.CACHES['memcache']['OPTIONS'], **options)})
+        self.addCleanup(_tiers.pop, ('circuit', name), None)
+        return guarded
+
+    def get_slow_memcached(self, delay):
+        server = SlowMemcachedServer(('127.0.0.1', 0), SlowMemcachedHandler)
+        server.delay = delay
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        location = '127.0.0.1:{port}'.format(port=server.server_address[1])
+        return MemcachedCache(location, {'OPTIONS': settings.CACHES['memcached']['OPTIONS']})
+
+    def assertShieldsFrom(self, delay, max_seconds):
+        guarded = self.get_guarded_cache(self.get_slow_memcached(delay), 'slow-memcached-{delay}'.format(delay=delay))
+        guarded.set('article_1', 'cached')
+        start = time.monotonic()
+        for i in range(50):
+            value = guarded.get('article_1')
+        elapsed = time.monotonic() - start
+        # served from the local store once the circuit opened
+        self.assertEqual(value, 'cached')
+        stats = guarded.get_stats()
+        self.assertTrue(stats['open'])
+        self.assertGreater(stats['hits'], 0)
+        # straight to the server the 50 reads take at least 50 * min(delay, socket timeout)
+        self.assertLess(elapsed, max_seconds)
+
+    def test_slower_than_slow_call_timeout(self):
+        # slow answers count as failures until the circuit opens
+        self.assertShieldsFrom(0.2, 2)
+
+    def test_slower_than_socket_timeout(self):
+        # python-memcached times out once, marks the server dead and returns misses from then on
+        self.assertShieldsFrom(1.0, 1)
+
+    def test_recovery_only_drops_keys_changed_during_the_outage(self):
+        backend = LocMemCache('breaker-recovery', {})
+        self.addCleanup(backend.clear)
+        guarded = self.get_guarded_cache(backend, 'breaker-recovery', MAX_DIRTY_KEYS=2, RECOVERY_TIMEOUT=60)
+        guarded.set('untouched', 1)
+        guarded.set('changed', 1)
+        for i in range(guarded.breaker.min_calls):
+            guarded.breaker.record(False)
+        for key in ('changed', 'overflow_1', 'overflow_2'):
+            guarded.set(key, 2)
+        self.assertEqual(backend.get('changed'), 1)
+
+        guarded.breaker.recovery_timeout = 0
+        # the probe succeeds and closes the circuit
+        self.assertEqual(guarded.get('untouched'), 1)
+        self.assertFalse(guarded.get_stats()['open'])
+        self.assertIsNone(backend.get('changed'))
+        self.assertEqual(backend.get('untouched'), 1)
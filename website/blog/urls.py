@@ -21,6 +21,8 @@ urlpatterns = [
 
     path(r'tag/<slug:tag_name>.html', views.TagDetailView.as_view(), name='tag_detail'),
     path(r'tag/<slug:tag_name>/<int:page>).html', views.TagDetailView.as_view(), name='tag_detail_page'),
+    path(r'archive/<int:year>/<int:month>.html', views.ArchiveView.as_view(), name='archive'),
+    path(r'archive/<int:year>/<int:month>/<int:page>.html', views.ArchiveView.as_view(), name='archive_page'),
     path(r'upload', views.fileupload, name='upload'),
     path(r'refresh', views.refresh_memcache, name='refresh')
 ]
@@ -5,14 +5,19 @@ import logging
 from django import forms
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.core.paginator import InvalidPage, Page
+from django.http import HttpResponse, Http404
 from django.shortcuts import render, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import ListView, DetailView
 
-from blog.models import Article, Tag, Category
+from accounts.models import BlogUser
+from blog.analytics import get_visitor_id
+from blog.directory import resolve_or_404
+from blog.models import Article, Tag, Category, ArchiveMonth
+from blog.pagination import KeysetPage, KeysetPaginator, decode_cursor
 from comments.forms import CommentForm
-from website.utils import cache, logger
+from website.utils import cache_get_tagged, cache_set_tagged, get_md5, logger
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +27,17 @@ class ArticleListView(ListView):
     context_object_name = 'article_list'
 
     page_type = ''
-    paginate_by = settings.PAGINATE_BY
+    paginate_by = None
     page_kwarg = 'page'
+    keyset_pagination = None
+
+    def get_paginate_by(self, queryset):
+        return self.paginate_by or settings.PAGINATE_BY
+
+    def get_keyset_pagination(self):
+        if self.keyset_pagination is None:
+            return settings.KEYSET_PAGINATION
+        return self.keyset_pagination
 
     def get_view_cache_key(self):
         return self.request.get['pages']
@@ -34,28 +48,100 @@ class ArticleListView(ListView):
         page = self.kwargs.get(page_kwarg) or self.request.GET.get(page_kwarg) or 1
         return page
 
+    def get_list_cache_key(self):
+        raise NotImplementedError()
+
     def get_queryset_cache_key(self):
+        return '{list}_{page}'.format(list=self.get_list_cache_key(), page=self.page_number)
+
+    def get_cache_tags(self):
+        """Dependency tags of the list; saving a matching article invalidates its cached pages."""
         raise NotImplementedError()
 
     def get_queryset_data(self):
         raise NotImplementedError()
 
     def get_queryset_from_cache(self, cache_key):
-        # raise NotImplementedError()
-        value = cache.get(cache_key)
-        if value:
+        """The ids of the articles on the current page and the total count, cached under cache_key."""
+        value, generations = cache_get_tagged(cache_key, self.get_cache_tags())
+        if value is not None:
             logger.info('get view cache.key:{key}'.format(key=cache_key))
             return value
-        else:
-            article_list = self.get_queryset_data()
-            cache.set(cache_key, article_list)
-            logger.info('set view cache.key:{key}'.format(key=cache_key))
-            return article_list
+        paginator, page, article_list, is_paginated = super(ArticleListView, self).paginate_queryset(
+            self.get_queryset_data().only('id', 'pub_time'), self.get_paginate_by(None))
+        value = {'ids': [article.id for article in article_list], 'count': paginator.count}
+        cache_set_tagged(cache_key, value, generations)
+        logger.info('set view cache.key:{key}'.format(key=cache_key))
+        return value
 
     def get_queryset(self):
-        key = self.get_queryset_cache_key()
-        value = self.get_queryset_from_cache(key)
-        return value
+        # the articles are only fetched by paginate_queryset, one page at a time
+        self.queryset_cache_key = self.get_queryset_cache_key()
+        return Article.objects.none()
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.get_keyset_pagination():
+            return self.paginate_keyset(page_size)
+        value = self.get_queryset_from_cache(self.queryset_cache_key)
+        paginator = self.get_paginator(queryset, page_size, orphans=self.get_paginate_orphans(),
+                                       allow_empty_first_page=self.get_allow_empty())
+        paginator.count = value['count']
+        page_number = self.page_number
+        try:
+            if page_number == 'last':
+                page_number = paginator.num_pages
+            page_number = paginator.validate_number(page_number)
+        except InvalidPage as e:
+            raise Http404('Invalid page (%(page_number)s): %(message)s' % {
+                'page_number': page_number,
+                'message': str(e)
+            })
+        article_list = Article.get_cached_articles(value['ids'])
+        page = Page(article_list, page_number, paginator)
+        return paginator, page, article_list, page.has_other_pages()
+
+    def paginate_keyset(self, page_size):
+        """Seek to the page of the ?cursor= parameter, or to a page number through the cached page map."""
+        list_key = self.get_list_cache_key()
+        cache_tags = self.get_cache_tags()
+        cursors_key = '{list}_cursors'.format(list=list_key)
+        cursor = self.request.GET.get('cursor')
+        key = direction = None
+        try:
+            if cursor:
+                key, page_number, direction = decode_cursor(cursor)
+            else:
+                page_number = int(self.page_number)
+                if page_number < 1:
+                    raise ValueError('page number is less than 1')
+                cursor = (cache_get_tagged(cursors_key, cache_tags)[0] or {}).get(page_number)
+                if cursor:
+                    key, page_number, direction = decode_cursor(cursor)
+        except ValueError as e:
+            raise Http404(str(e))
+
+        cache_key = '{list}_keyset_{position}'.format(list=list_key,
+                                                      position=get_md5(cursor) if cursor else page_number)
+        value, generations = cache_get_tagged(cache_key, cache_tags)
+        if value is None:
+            paginator = KeysetPaginator(self.get_queryset_data().only('id', 'pub_time'), page_size)
+            page = paginator.page(page_number, key, direction)
+            value = {'ids': [article.id for article in page],
+                     'next_cursor': page.next_cursor,
+                     'previous_cursor': page.previous_cursor}
+            cache_set_tagged(cache_key, value, generations)
+            if page.next_cursor:
+                # later requests for the next page number can seek instead of using an OFFSET
+                cursors = cache_get_tagged(cursors_key, cache_tags)[0] or {}
+                if cursors.get(page_number + 1) != page.next_cursor:
+                    cursors[page_number + 1] = page.next_cursor
+                    cache_set_tagged(cursors_key, cursors, generations)
+        if not value['ids'] and page_number > 1:
+            raise Http404('Invalid page (%s): That page contains no results' % page_number)
+
+        article_list = Article.get_cached_articles(value['ids'])
+        page = KeysetPage(article_list, page_number, value['next_cursor'], value['previous_cursor'])
+        return KeysetPaginator(Article.objects.none(), page_size), page, article_list, page.has_other_pages()
 
 
 class IndexView(ArticleListView):
@@ -63,9 +149,11 @@ class IndexView(ArticleListView):
         article_list = Article.objects.filter(type='a', status='p')
         return article_list
 
-    def get_queryset_cache_key(self):
-        cache_key = 'index_{page}'.format(page=self.page_number)
-        return cache_key
+    def get_list_cache_key(self):
+        return 'index'
+
+    def get_cache_tags(self):
+        return ['index']
 
 
 class ArticleDetailView(DetailView):
@@ -74,9 +162,12 @@ class ArticleDetailView(DetailView):
     pk_url_kwarg = 'article_id'
     context_object_name = "article"
 
+    def get_queryset(self):
+        return Article.objects.select_related('author', 'category').prefetch_related('tags')
+
     def get_object(self, queryset=None):
         obj = super(ArticleDetailView, self).get_object()
-        obj.viewed()
+        obj.viewed(get_visitor_id(self.request))
         self.object = obj
         return obj
 
@@ -98,6 +189,9 @@ class ArticleDetailView(DetailView):
         kwargs['form'] = comment_form
         kwargs['article_comments'] = article_comments
         kwargs['comment_count'] = len(article_comments) if article_comments else 0
+        self.object.comment_count = kwargs['comment_count']
+        # one lookup for the avatars of every commenter
+        kwargs['comment_avatars'] = BlogUser.get_avatars(comment.author_id for comment in article_comments)
 
         kwargs['next_article'] = self.object.next_article
         kwargs['prev_article'] = self.object.prev_article
@@ -109,23 +203,21 @@ class CategoryDetailView(ArticleListView):
     page_type = "分类目录归档"
 
     def get_queryset_data(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
-
-        categoryname = category.name
-        self.categoryname = categoryname
-        categorynames = list(map(lambda c: c.name, category.get_sub_categorys()))
-        article_list = Article.objects.filter(category__name__in=categorynames, status='p')
+        category = resolve_or_404('category', self.kwargs['category_name'])
+        category_ids = Category.get_tree().get_descendant_ids(category.id)
+        article_list = Article.objects.filter(category_id__in=category_ids, status='p')
         return article_list
 
-    def get_queryset_cache_key(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
-        categoryname = category.name
-        self.categoryname = categoryname
-        cache_key = 'category_list_{categoryname}_{page}'.format(categoryname=categoryname, page=self.page_number)
+    def get_list_cache_key(self):
+        category = resolve_or_404('category', self.kwargs['category_name'])
+        self.categoryname = category.name
+        cache_key = 'category_list_{categoryname}'.format(categoryname=category.name)
         return cache_key
 
+    def get_cache_tags(self):
+        category = resolve_or_404('category', self.kwargs['category_name'])
+        return ['category:{id}'.format(id=category.id)]
+
     def get_context_data(self, **kwargs):
 
         categoryname = self.categoryname
@@ -141,14 +233,18 @@ class CategoryDetailView(ArticleListView):
 class AuthorDetailView(ArticleListView):
     page_type = 'Article'
 
-    def get_queryset_cache_key(self):
+    def get_list_cache_key(self):
         author_name = self.kwargs['author_name']
-        cache_key = 'author_{author_name}_{page}'.format(author_name=author_name, page=self.page_number)
+        cache_key = 'author_{author_name}'.format(author_name=author_name)
         return cache_key
 
+    def get_cache_tags(self):
+        author = resolve_or_404('author', self.kwargs['author_name'])
+        return ['author:{id}'.format(id=author.id)]
+
     def get_queryset_data(self):
-        author_name = self.kwargs['author_name']
-        article_list = Article.objects.filter(author__username=author_name)
+        author = resolve_or_404('author', self.kwargs['author_name'])
+        article_list = Article.objects.filter(author_id=author.id)
         return article_list
 
     def get_context_data(self, **kwargs):
@@ -158,6 +254,41 @@ class AuthorDetailView(ArticleListView):
         return super(AuthorDetailView, self).get_context_data(**kwargs)
 
 
+class ArchiveView(ArticleListView):
+    page_type = 'Monthly archive'
+
+    def get_archive_month(self):
+        if not hasattr(self, 'archive_month'):
+            self.archive_month = get_object_or_404(ArchiveMonth, year=self.kwargs['year'], month=self.kwargs['month'])
+        return self.archive_month
+
+    def get_list_cache_key(self):
+        archive = self.get_archive_month()
+        cache_key = 'archive_{archive}'.format(archive=archive)
+        return cache_key
+
+    def get_cache_tags(self):
+        return ['archive:{archive}'.format(archive=self.get_archive_month())]
+
+    def get_queryset_data(self):
+        archive = self.get_archive_month()
+        start, end = ArchiveMonth.get_month_range(archive.year, archive.month)
+        article_list = Article.objects.filter(status='p', created_time__gte=start, created_time__lt=end)
+        return article_list
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        paginator = super(ArchiveView, self).get_paginator(queryset, per_page, orphans, allow_empty_first_page,
+                                                           **kwargs)
+        # the archive index already knows the size of the month
+        paginator.count = self.get_archive_month().count
+        return paginator
+
+    def get_context_data(self, **kwargs):
+        kwargs['page_type'] = ArchiveView.page_type
+        kwargs['tag_name'] = str(self.get_archive_month())
+        return super(ArchiveView, self).get_context_data(**kwargs)
+
+
 class TagListView(ListView):
     template_name = ''
     context_object_name = 'tag_list'
@@ -173,21 +304,20 @@ class TagDetailView(ArticleListView):
     page_type = '分类标签归档'
 
     def get_queryset_data(self):
-        slug = self.kwargs['tag_name']
-        tag = get_object_or_404(Tag, slug=slug)
-        tag_name = tag.name
-        self.name = tag_name
-        article_list = Article.objects.filter(tags__name=tag_name)
+        tag = resolve_or_404('tag', self.kwargs['tag_name'])
+        article_list = Article.objects.filter(tags__id=tag.id)
         return article_list
 
-    def get_queryset_cache_key(self):
-        slug = self.kwargs['tag_name']
-        tag = get_object_or_404(Tag, slug=slug)
-        tag_name = tag.name
-        self.name = tag_name
-        cache_key = 'tag_{tag_name}_{page}'.format(tag_name=tag_name, page=self.page_number)
+    def get_list_cache_key(self):
+        tag = resolve_or_404('tag', self.kwargs['tag_name'])
+        self.name = tag.name
+        cache_key = 'tag_{tag_name}'.format(tag_name=tag.name)
         return cache_key
 
+    def get_cache_tags(self):
+        tag = resolve_or_404('tag', self.kwargs['tag_name'])
+        return ['tag:{id}'.format(id=tag.id)]
+
     def get_context_data(self, **kwargs):
         # tag_name = self.kwargs['tag_name']
         tag_name = self.name
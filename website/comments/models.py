@@ -2,10 +2,13 @@ from django.conf import settings
 from django.db import models
 
 from blog.models import Article
+from website.utils import CommonMarkdown, get_markdown_render_version
 
 
 class Comment(models.Model):
     body = models.TextField('body', max_length=300)
+    body_html = models.TextField(blank=True, editable=False)
+    render_version = models.CharField(max_length=32, blank=True, editable=False)
     created_time = models.DateTimeField('Created Time', auto_now_add=True)
     last_mod_time = models.DateTimeField('Modified', auto_now=True)
     author = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Author', on_delete=models.CASCADE)
@@ -22,5 +25,39 @@ class Comment(models.Model):
     def __str__(self):
         return self.body
 
+    RENDER_FIELDS = ('body_html', 'render_version')
+    # cached comment lists carry only these author columns, never the password hash or the email
+    LIST_AUTHOR_FIELDS = ('username', 'nickname', 'is_superuser')
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            self.render_body()
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + list(Comment.RENDER_FIELDS)
         super().save(*args, **kwargs)
+
+    @staticmethod
+    def get_render_version():
+        return get_markdown_render_version()
+
+    @staticmethod
+    def render_fields(body, body_html=None):
+        if body_html is None:
+            body_html = CommonMarkdown.get_cached_markdown(body)
+        return {
+            'body_html': body_html,
+            'render_version': Comment.get_render_version(),
+        }
+
+    def render_body(self):
+        for field, value in Comment.render_fields(self.body).items():
+            setattr(self, field, value)
+
+    def get_body_html(self):
+        if self.render_version != Comment.get_render_version():
+            # rendered by an older renderer, or saved before the html was stored
+            self.render_body()
+            if self.pk:
+                Comment.objects.filter(pk=self.pk).update(**{f: getattr(self, f) for f in Comment.RENDER_FIELDS})
+        return self.body_html
@@ -2,17 +2,26 @@
 # encoding: utf-8
 
 from django import template
+from django.utils.safestring import mark_safe
 
 register = template.Library()
 
 
+@register.simple_tag
+def get_root_comments(commentlist):
+    return [c for c in commentlist if c.parent_comment_id is None]
+
+
 @register.simple_tag
 def parse_commenttree(commentlist, comment):
+    """The replies below comment, depth first, picked from the article's comments without queries."""
+    childs = {}
+    for c in commentlist:
+        childs.setdefault(c.parent_comment_id, []).append(c)
     datas = []
 
     def parse(c):
-        childs = commentlist.filter(parent_comment=c, is_enable=True)
-        for child in childs:
+        for child in childs.get(c.id, []):
             datas.append(child)
             parse(child)
 
@@ -21,10 +30,12 @@ def parse_commenttree(commentlist, comment):
 
 
 @register.inclusion_tag('comments/tags/comment_item.html')
-def show_comment_item(comment, ischild):
+def show_comment_item(comment, ischild, avatars=None):
     """评论"""
     depth = 1 if ischild else 2
     return {
         'comment_item': comment,
+        'avatar': (avatars or {}).get(comment.author_id),
+        'content': mark_safe(comment.get_body_html()),
         'depth': depth
     }
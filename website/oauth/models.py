@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.db import models
 
+from website.utils import cache, get_md5
+
 
 class OAuthUser(models.Model):
     author = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
@@ -18,6 +20,27 @@ class OAuthUser(models.Model):
     def __str__(self):
         return self.nikename
 
+    @staticmethod
+    def get_picture_cache_key(email):
+        return 'oauth_picture_{digest}'.format(digest=get_md5(email))
+
+    @staticmethod
+    def get_pictures(emails):
+        """Picture of the first account with one for each email, '' when there is none; cached per email."""
+        keys = {email: OAuthUser.get_picture_cache_key(email) for email in set(emails) if email}
+        cached = cache.get_many(keys.values())
+        pictures = {email: cached[key] for email, key in keys.items() if key in cached}
+        missing = [email for email in keys if email not in pictures]
+        if missing:
+            loaded = {}
+            for email, picture in OAuthUser.objects.filter(email__in=missing, picture__isnull=False) \
+                    .order_by('id').values_list('email', 'picture'):
+                loaded.setdefault(email, picture)
+            loaded = {email: loaded.get(email, '') for email in missing}
+            cache.set_many({keys[email]: picture for email, picture in loaded.items()})
+            pictures.update(loaded)
+        return pictures
+
     class Meta:
         verbose_name = 'OAuthUser'
         verbose_name_plural = verbose_name
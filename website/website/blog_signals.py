@@ -13,18 +13,195 @@
 @time: 2017/8/12 上午10:18
 """
 
+from functools import partial
+
 import django.dispatch
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save, m2m_changed
 from django.dispatch import receiver
 
-from website.utils import cache, logger
+from website.utils import cache, logger, invalidate_cache_tags, site_domain
 
 comment_save_signal = django.dispatch.Signal(providing_args=["comment_id", "username", "serverport"])
 article_save_signal = django.dispatch.Signal(providing_args=['id', 'is_update_views'])
 user_login_logout_signal = django.dispatch.Signal(providing_args=['id', 'type'])
 
 
+def after_commit(func, *args):
+    """Call func(*args) once the current transaction commits, or right away outside one.
+
+    Expiring cached data before the commit lets a concurrent request cache the old rows
+    again under the new generation or stamp, where they would stay until the next change.
+    """
+    transaction.on_commit(partial(func, *args))
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def site_changed_callback(sender, **kwargs):
+    # the domain is part of the render version, so stored html goes stale and is rebuilt
+    after_commit(site_domain.expire)
+
+
+@receiver(post_save, sender='blog.Article')
+@receiver(post_delete, sender='blog.Article')
+def article_changed_callback(sender, instance, **kwargs):
+    from blog.counters import most_read_index
+    from blog.models import Article, article_adjacency
+    after_commit(most_read_index.update_articles, [instance.id])
+    after_commit(Article.expire_cached_articles, [instance.id])
+    # publishing, unpublishing, renaming or deleting changes the neighbour links
+    after_commit(article_adjacency.expire)
+
+
+@receiver(pre_save, sender='blog.Article')
+def article_pre_save_callback(sender, instance, **kwargs):
+    # the save may move the article out of lists it was cached in
+    from blog.models import Article
+    old = Article.objects.filter(pk=instance.pk).only('id', 'author_id', 'category_id', 'created_time', 'type') \
+        .first() if instance.pk else None
+    instance._old_cache_tags = old.get_cache_tags() if old else []
+
+
+@receiver(post_save, sender='blog.Article')
+def article_cache_tags_callback(sender, instance, **kwargs):
+    after_commit(invalidate_cache_tags, *getattr(instance, '_old_cache_tags', []), *instance.get_cache_tags())
+
+
+@receiver(post_save, sender='blog.Category')
+@receiver(post_delete, sender='blog.Category')
+def category_tree_changed_callback(sender, **kwargs):
+    from blog.models import category_tree
+    after_commit(category_tree.expire)
+
+
+@receiver(post_save, sender='blog.Category')
+@receiver(post_delete, sender='blog.Category')
+@receiver(post_save, sender='blog.Tag')
+@receiver(post_delete, sender='blog.Tag')
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def slug_directory_changed_callback(sender, **kwargs):
+    from blog.directory import slug_directory
+    after_commit(slug_directory.expire)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_changed_callback(sender, instance, update_fields=None, **kwargs):
+    # logins only write last_login
+    if update_fields is None or 'username' in update_fields:
+        slug_directory_changed_callback(sender, **kwargs)
+    if update_fields is None or 'email' in update_fields:
+        after_commit(cache.delete, instance.get_avatar_cache_key(instance.id))
+
+
+def expire_sidebar_cache():
+    after_commit(invalidate_cache_tags, 'sidebar')
+
+
+def sidebar_changed_callback(sender, **kwargs):
+    expire_sidebar_cache()
+
+
+for sidebar_model in ('blog.Article', 'blog.Category', 'blog.Tag', 'blog.Links', 'blog.SideBar', 'comments.Comment'):
+    post_save.connect(sidebar_changed_callback, sender=sidebar_model)
+    post_delete.connect(sidebar_changed_callback, sender=sidebar_model)
+
+
+@receiver(post_save, sender='blog.Article')
+def article_tag_counts_callback(sender, instance, **kwargs):
+    # the status may have changed, which moves the article in or out of its tags' and month's counts
+    from blog.models import Tag, ArchiveMonth
+    Tag.refresh_article_counts(instance.tags.values_list('id', flat=True))
+    ArchiveMonth.refresh_months([instance.get_archive_month()])
+
+
+@receiver(pre_delete, sender='blog.Article')
+def article_pre_delete_callback(sender, instance, **kwargs):
+    # the tag links are deleted without m2m_changed, remember them for post_delete
+    instance._deleted_tag_ids = list(instance.tags.values_list('id', flat=True))
+    instance._old_cache_tags = instance.get_cache_tags(instance._deleted_tag_ids)
+
+
+@receiver(post_delete, sender='blog.Article')
+def article_post_delete_callback(sender, instance, **kwargs):
+    from blog.models import Tag, ArchiveMonth
+    Tag.refresh_article_counts(getattr(instance, '_deleted_tag_ids', []))
+    ArchiveMonth.refresh_months([instance.get_archive_month()])
+    after_commit(invalidate_cache_tags, *getattr(instance, '_old_cache_tags', []))
+
+
+@receiver(m2m_changed, sender='blog.Article_tags')
+def article_tags_changed_callback(sender, instance, action, reverse, pk_set, **kwargs):
+    from blog.models import Article, Tag
+    if action == 'pre_clear':
+        instance._cleared_tag_ids = [instance.pk] if reverse else list(instance.tags.values_list('id', flat=True))
+        instance._cleared_article_ids = list(instance.article_set.values_list('id', flat=True)) if reverse \
+            else [instance.pk]
+        return
+    if action == 'post_clear':
+        tag_ids = getattr(instance, '_cleared_tag_ids', [])
+        article_ids = getattr(instance, '_cleared_article_ids', [])
+    elif action in ('post_add', 'post_remove'):
+        tag_ids = [instance.pk] if reverse else pk_set
+        article_ids = pk_set if reverse else [instance.pk]
+    else:
+        return
+    Tag.refresh_article_counts(tag_ids)
+    after_commit(Article.expire_cached_articles, list(article_ids))
+    after_commit(invalidate_cache_tags, *['tag:{id}'.format(id=id) for id in tag_ids],
+                 *['article:{id}'.format(id=id) for id in article_ids])
+    expire_sidebar_cache()
+
+
+@receiver(post_save, sender='comments.Comment')
+@receiver(post_delete, sender='comments.Comment')
+def comment_changed_callback(sender, instance, **kwargs):
+    # cached list entries carry the comment count
+    from blog.models import Article
+    after_commit(Article.expire_cached_articles, [instance.article_id])
+    after_commit(invalidate_cache_tags, 'article:{id}'.format(id=instance.article_id))
+
+
+@receiver(post_save, sender='oauth.OAuthUser')
+@receiver(post_delete, sender='oauth.OAuthUser')
+def oauth_user_changed_callback(sender, instance, **kwargs):
+    # comment avatars are looked up by email
+    if instance.email:
+        from accounts.models import BlogUser
+        user_ids = BlogUser.objects.filter(email=instance.email).values_list('id', flat=True)
+        after_commit(cache.delete_many, [instance.get_picture_cache_key(instance.email)] +
+                     [BlogUser.get_avatar_cache_key(id) for id in user_ids])
+
+
+@receiver(post_save, sender='blog.Category')
+@receiver(post_save, sender='blog.Tag')
+def article_relation_changed_callback(sender, instance, **kwargs):
+    # cached list entries carry their category and tags
+    from blog.models import Article
+    articles = Article.objects.filter(category=instance) if sender.__name__ == 'Category' \
+        else instance.article_set.all()
+    after_commit(Article.expire_cached_articles, list(articles.values_list('id', flat=True)))
+    after_commit(invalidate_cache_tags, '{kind}:{id}'.format(kind=sender.__name__.lower(), id=instance.id))
+
+
+def articles_status_changed(ids):
+    """Update what depends on article status after a bulk update that sent no model signals."""
+    from blog.counters import most_read_index
+    from blog.models import Article, Tag, ArchiveMonth, article_adjacency
+
+    after_commit(most_read_index.update_articles, ids)
+    after_commit(Article.expire_cached_articles, ids)
+    after_commit(article_adjacency.expire)
+    tag_ids = list(Article.tags.through.objects.filter(article_id__in=ids).values_list('tag_id', flat=True))
+    Tag.refresh_article_counts(tag_ids)
+    articles = Article.objects.filter(id__in=ids).only('id', 'author_id', 'category_id', 'created_time', 'type')
+    ArchiveMonth.refresh_months([a.get_archive_month() for a in articles])
+    after_commit(invalidate_cache_tags, *[tag for a in articles for tag in a.get_cache_tags(tag_ids=[])],
+                 *['tag:{id}'.format(id=id) for id in tag_ids])
+
+
 @receiver(article_save_signal)
 def article_save_callback(sender, **kwargs):
     id = kwargs['id']
@@ -92,9 +269,3 @@ def comment_save_callback(sender, **kwargs):
     # expire_view_cache(path, servername=site, serverport=serverport, key_prefix='blogdetail')
     if cache.get('seo_processor'):
         cache.delete('seo_processor')
-    comment_cache_key = 'article_comments_{id}'.format(id=article.id)
-    cache.delete(comment_cache_key)
-    from django.core.cache.utils import make_template_fragment_key
-
-    key = make_template_fragment_key('sidebar', [username])
-    cache.delete(key)
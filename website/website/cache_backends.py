@@ -0,0 +1,434 @@
+"""Cache backends layered over the ones Django ships."""
+import logging
+import threading
+import time
+from collections import deque
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from website.utils import LRUCache
+
+logger = logging.getLogger(__name__)
+_missing = LRUCache._missing
+
+# per process, shared by every thread's backend instance, like LocMemCache's storage
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+class _Tier():
+    def __init__(self, maxsize, timeout):
+        self.l1 = LRUCache(maxsize=maxsize, timeout=timeout)
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.checked = 0
+
+
+class TieredCache(BaseCache):
+    """An in-process LRU (L1) in front of another cache alias (L2), usually memcached.
+
+    LOCATION names the L2 alias. Only the keys in OPTIONS['L1_KEYS'] and keys starting with
+    one of OPTIONS['L1_KEY_PREFIXES'] are kept in L1, for at most OPTIONS['L1_TIMEOUT'] seconds.
+    Every write or delete of such a key moves a shared stamp in L2 forward; each process reads
+    the stamp at most every OPTIONS['STAMP_CHECK_INTERVAL'] seconds and drops its L1 when it
+    moved, which bounds how long another worker's change can stay invisible.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.l2_alias = location
+        self.l1_keys = frozenset(options.get('L1_KEYS', ()))
+        self.l1_key_prefixes = tuple(options.get('L1_KEY_PREFIXES', ()))
+        self.stamp_key = options.get('STAMP_KEY', 'tiered_cache_stamp')
+        self.stamp_check_interval = options.get('STAMP_CHECK_INTERVAL', 1)
+        with _tiers_lock:
+            if location not in _tiers:
+                _tiers[location] = _Tier(options.get('L1_MAX_ENTRIES', 1000), options.get('L1_TIMEOUT', 5))
+            self.tier = _tiers[location]
+        self.l1 = self.tier.l1
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def in_l1(self, key):
+        return key in self.l1_keys or key.startswith(self.l1_key_prefixes)
+
+    def get_l1_key(self, key, version):
+        return self.l2.make_key(key, version=version)
+
+    def get_l1_timeout(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.l2.default_timeout
+        return timeout
+
+    def check_stamp(self):
+        tier = self.tier
+        now = time.monotonic()
+        if now - tier.checked < self.stamp_check_interval:
+            return
+        stamp = self.l2.get(self.stamp_key)
+        with tier.lock:
+            tier.checked = now
+            if stamp != tier.stamp:
+                self.l1.clear()
+                tier.stamp = stamp
+
+    def bump_stamp(self):
+        tier = self.tier
+        try:
+            stamp = self.l2.incr(self.stamp_key)
+        except ValueError:
+            stamp = int(time.time() * 1000)
+            self.l2.set(self.stamp_key, stamp, None)
+            known = None
+        else:
+            known = stamp - 1
+        with tier.lock:
+            # another worker bumped it since we last looked, so our L1 may be stale too
+            if tier.stamp != known:
+                self.l1.clear()
+            tier.stamp = stamp
+            tier.checked = time.monotonic()
+
+    def get(self, key, default=None, version=None):
+        if self.in_l1(key):
+            self.check_stamp()
+            l1_key = self.get_l1_key(key, version)
+            value = self.l1.get(l1_key, _missing)
+            if value is not _missing:
+                return value
+            value = self.l2.get(key, _missing, version=version)
+            if value is _missing:
+                return default
+            self.l1.set(l1_key, value)
+            return value
+        return self.l2.get(key, default, version=version)
+
+    def get_many(self, keys, version=None):
+        found = {}
+        remote = []
+        if any(self.in_l1(key) for key in keys):
+            self.check_stamp()
+        for key in keys:
+            value = self.l1.get(self.get_l1_key(key, version), _missing) if self.in_l1(key) else _missing
+            if value is _missing:
+                remote.append(key)
+            else:
+                found[key] = value
+        if remote:
+            values = self.l2.get_many(remote, version=version)
+            for key, value in values.items():
+                if self.in_l1(key):
+                    self.l1.set(self.get_l1_key(key, version), value)
+            found.update(values)
+        return found
+
+    def has_key(self, key, version=None):
+        return self.get(key, _missing, version=version) is not _missing
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # a new key cannot be stale anywhere, misses are never kept in L1
+        added = self.l2.add(key, value, timeout, version=version)
+        if added and self.in_l1(key):
+            self.l1.set(self.get_l1_key(key, version), value, self.get_l1_timeout(timeout))
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.l2.set(key, value, timeout, version=version)
+        if self.in_l1(key):
+            self.bump_stamp()
+            self.l1.set(self.get_l1_key(key, version), value, self.get_l1_timeout(timeout))
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.l2.set_many(data, timeout, version=version) or []
+        local = {key: value for key, value in data.items() if self.in_l1(key) and key not in failed}
+        if local:
+            self.bump_stamp()
+            for key, value in local.items():
+                self.l1.set(self.get_l1_key(key, version), value, self.get_l1_timeout(timeout))
+        return failed
+
+    def delete(self, key, version=None):
+        self.l2.delete(key, version=version)
+        if self.in_l1(key):
+            self.l1.delete(self.get_l1_key(key, version))
+            self.bump_stamp()
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.l2.delete_many(keys, version=version)
+        local = [key for key in keys if self.in_l1(key)]
+        if local:
+            for key in local:
+                self.l1.delete(self.get_l1_key(key, version))
+            self.bump_stamp()
+
+    def incr(self, key, delta=1, version=None):
+        value = self.l2.incr(key, delta, version=version)
+        if self.in_l1(key):
+            self.bump_stamp()
+            self.l1.set(self.get_l1_key(key, version), value)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def clear(self):
+        self.l2.clear()
+        self.l1.clear()
+        self.bump_stamp()
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
+
+    def get_stats(self):
+        """Hit and miss counters of this process's L1."""
+        return self.l1.stats()
+
+
+class CircuitBreaker():
+    """Tracks the outcome of recent calls and opens after too many of them fail or are slow.
+
+    While open every call is refused until recovery_timeout has passed; then a single
+    probe call is let through, which closes the circuit when it succeeds.
+    """
+
+    def __init__(self, window=20, min_calls=5, failure_rate=0.5, recovery_timeout=10):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.recovery_timeout = recovery_timeout
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Whether a call may go through; while open, True only for the one probe."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, ok):
+        """Record a call; returns 'opened' or 'closed' when the state changed."""
+        with self.lock:
+            if self.opened_at is not None:
+                self.probing = False
+                if ok:
+                    self.opened_at = None
+                    self.outcomes.clear()
+                    return 'closed'
+                self.opened_at = time.monotonic()
+                return None
+            self.outcomes.append(ok)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures >= len(self.outcomes) * self.failure_rate:
+                self.opened_at = time.monotonic()
+                return 'opened'
+            return None
+
+
+class CircuitBreakerCache(BaseCache):
+    """Guards another cache alias (LOCATION) with a CircuitBreaker.
+
+    Calls that raise, take longer than OPTIONS['SLOW_CALL_TIMEOUT'] seconds, or find every
+    memcached server marked dead count as failures. While the circuit is open, reads and
+    writes go to a bounded local LRUCache that is kept warm with what passed through
+    before. Keys written while open are deleted from the guarded cache once it recovers,
+    since it missed those changes; past OPTIONS['MAX_DIRTY_KEYS'] the rest are left to expire.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.backend_alias = location
+        self.slow_call_timeout = options.get('SLOW_CALL_TIMEOUT', 0.1)
+        self.max_dirty_keys = options.get('MAX_DIRTY_KEYS', 10000)
+        with _tiers_lock:
+            key = ('circuit', location)
+            if key not in _tiers:
+                _tiers[key] = (CircuitBreaker(window=options.get('WINDOW', 20),
+                                              min_calls=options.get('MIN_CALLS', 5),
+                                              failure_rate=options.get('FAILURE_RATE', 0.5),
+                                              recovery_timeout=options.get('RECOVERY_TIMEOUT', 10)),
+                               LRUCache(maxsize=options.get('LOCAL_MAX_ENTRIES', 1000),
+                                        timeout=options.get('LOCAL_TIMEOUT', 300)),
+                               set())
+            self.breaker, self.local, self.dirty_keys = _tiers[key]
+
+    @property
+    def backend(self):
+        return caches[self.backend_alias]
+
+    def get_local_key(self, key, version):
+        return self.backend.make_key(key, version=version)
+
+    def is_backend_down(self):
+        """Whether python-memcached has marked every server dead.
+
+        It does that instead of raising when a server times out or refuses connections, and
+        then answers each call with a miss or a failed write until dead_retry has passed.
+        """
+        servers = getattr(getattr(self.backend, '_cache', None), 'servers', None)
+        if not servers:
+            return False
+        now = time.time()
+        return all(getattr(server, 'deaduntil', 0) > now for server in servers)
+
+    def call(self, method, *args, **kwargs):
+        """Run a backend call; returns (ok, result), with ok False when it was refused or failed."""
+        if not self.breaker.allow():
+            return False, None
+        start = time.monotonic()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            logger.warning('cache call {name} failed: {error}'.format(name=method.__name__, error=e))
+            self.on_state_change(self.breaker.record(False))
+            return False, None
+        if self.is_backend_down():
+            # the result is a placeholder, not an answer from memcached
+            self.on_state_change(self.breaker.record(False))
+            return False, None
+        self.on_state_change(self.breaker.record(time.monotonic() - start <= self.slow_call_timeout))
+        return True, result
+
+    def on_state_change(self, change):
+        if change == 'opened':
+            logger.error('cache {alias} is failing, serving from the local store'.format(alias=self.backend_alias))
+        elif change == 'closed':
+            logger.warning('cache {alias} recovered'.format(alias=self.backend_alias))
+            dirty, overflow = list(self.dirty_keys), len(self.dirty_keys) >= self.max_dirty_keys
+            self.dirty_keys.clear()
+            if overflow:
+                # flushing everything would cost every worker a cold cache at once
+                logger.warning('more than {count} keys changed during the outage, the others expire on their '
+                               'own'.format(count=self.max_dirty_keys))
+            try:
+                for key, version in dirty:
+                    self.backend.delete(key, version=version)
+            except Exception as e:
+                logger.warning('dropping keys changed during the outage failed: {error}'.format(error=e))
+
+    def mark_dirty(self, key, version):
+        if len(self.dirty_keys) < self.max_dirty_keys:
+            self.dirty_keys.add((key, version))
+
+    def get(self, key, default=None, version=None):
+        local_key = self.get_local_key(key, version)
+        ok, value = self.call(self.backend.get, key, _missing, version=version)
+        if not ok:
+            value = self.local.get(local_key, _missing)
+        elif value is not _missing:
+            self.local.set(local_key, value)
+        return default if value is _missing else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        ok, values = self.call(self.backend.get_many, keys, version=version)
+        if ok:
+            for key, value in values.items():
+                self.local.set(self.get_local_key(key, version), value)
+            return values
+        values = {}
+        for key in keys:
+            value = self.local.get(self.get_local_key(key, version), _missing)
+            if value is not _missing:
+                values[key] = value
+        return values
+
+    def has_key(self, key, version=None):
+        return self.get(key, _missing, version=version) is not _missing
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.get_local_key(key, version)
+        ok, added = self.call(self.backend.add, key, value, timeout, version=version)
+        if not ok:
+            added = self.local.get(local_key, _missing) is _missing
+            self.mark_dirty(key, version)
+        if added:
+            self.local.set(local_key, value)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        ok, _ = self.call(self.backend.set, key, value, timeout, version=version)
+        if not ok:
+            self.mark_dirty(key, version)
+        self.local.set(self.get_local_key(key, version), value)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        ok, failed = self.call(self.backend.set_many, data, timeout, version=version)
+        for key, value in data.items():
+            if not ok:
+                self.mark_dirty(key, version)
+            self.local.set(self.get_local_key(key, version), value)
+        return failed or []
+
+    def delete(self, key, version=None):
+        ok, _ = self.call(self.backend.delete, key, version=version)
+        if not ok:
+            self.mark_dirty(key, version)
+        self.local.delete(self.get_local_key(key, version))
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        ok, _ = self.call(self.backend.delete_many, keys, version=version)
+        for key in keys:
+            if not ok:
+                self.mark_dirty(key, version)
+            self.local.delete(self.get_local_key(key, version))
+
+    def incr(self, key, delta=1, version=None):
+        local_key = self.get_local_key(key, version)
+        if self.breaker.allow():
+            # let a missing key raise ValueError as usual, only backend failures fall back
+            start = time.monotonic()
+            try:
+                value = self.backend.incr(key, delta, version=version)
+            except ValueError:
+                # a dead server answers incr like a missing key
+                if not self.is_backend_down():
+                    self.on_state_change(self.breaker.record(True))
+                    raise
+                self.on_state_change(self.breaker.record(False))
+            except Exception as e:
+                logger.warning('cache call incr failed: {error}'.format(error=e))
+                self.on_state_change(self.breaker.record(False))
+            else:
+                self.on_state_change(self.breaker.record(time.monotonic() - start <= self.slow_call_timeout))
+                self.local.set(local_key, value)
+                return value
+        value = self.local.get(local_key, _missing)
+        if value is _missing:
+            raise ValueError("Key '%s' not found" % key)
+        value += delta
+        self.mark_dirty(key, version)
+        self.local.set(local_key, value)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def clear(self):
+        ok, _ = self.call(self.backend.clear)
+        self.local.clear()
+
+    def close(self, **kwargs):
+        try:
+            self.backend.close(**kwargs)
+        except Exception as e:
+            logger.warning('closing cache {alias} failed: {error}'.format(alias=self.backend_alias, error=e))
+
+    def get_stats(self):
+        return dict(self.local.stats(), open=self.breaker.is_open, dirty_keys=len(self.dirty_keys))
@@ -0,0 +1,100 @@
+import logging
+import re
+import sys
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Node
+
+logger = logging.getLogger(__name__)
+
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_in_list_pattern = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_sql_shape(sql):
+    """SQL with literals and IN lists collapsed, so repeats of one query group together."""
+    return _in_list_pattern.sub('(?)', _literal_pattern.sub('?', sql))
+
+
+def get_query_origin():
+    """The template node and the project code that triggered the current query."""
+    template = code = None
+    frame = sys._getframe(2)
+    while frame and not (template and code):
+        node = frame.f_locals.get('self')
+        # not isinstance: on a lazy object such as request.user it would load it, and run a query
+        if template is None and issubclass(type(node), Node) and getattr(node, 'token', None) and \
+                getattr(node, 'origin', None):
+            template = '{name}:{line} {{% {contents} %}}'.format(name=node.origin.template_name,
+                                                                 line=node.token.lineno,
+                                                                 contents=node.token.contents[:60])
+        filename = frame.f_code.co_filename
+        if code is None and filename.startswith(settings.BASE_DIR) and filename != __file__:
+            code = '{file}:{line} in {func}'.format(file=filename[len(settings.BASE_DIR) + 1:],
+                                                    line=frame.f_lineno, func=frame.f_code.co_name)
+        frame = frame.f_back
+    return ' <- '.join(o for o in (template, code) if o) or 'unknown'
+
+
+class QueryRecorder():
+    def __init__(self):
+        self.shapes = Counter()
+        self.origins = defaultdict(Counter)
+
+    def __call__(self, execute, sql, params, many, context):
+        shape = get_sql_shape(sql)
+        self.shapes[shape] += 1
+        self.origins[shape][get_query_origin()] += 1
+        return execute(sql, params, many, context)
+
+    @property
+    def count(self):
+        return sum(self.shapes.values())
+
+
+class QueryBudgetMiddleware():
+    """Development and test aid: counts the SQL queries of each request.
+
+    Queries repeated QUERY_REPEAT_THRESHOLD times or more are logged as likely N+1
+    patterns with the template tag and code they came from. A request whose URL
+    name has an entry in QUERY_BUDGETS and runs more queries than that fails when
+    QUERY_BUDGET_RAISE is set, which the test settings do.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_BUDGET_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        response['X-Query-Count'] = str(recorder.count)
+
+        view_name = request.resolver_match.view_name if request.resolver_match else None
+        for shape, count in recorder.shapes.items():
+            if count >= settings.QUERY_REPEAT_THRESHOLD:
+                origins = ', '.join('%s (%d)' % o for o in recorder.origins[shape].most_common(3))
+                logger.warning('possible N+1 in {view}: {count}x {shape} from {origins}'.format(
+                    view=view_name, count=count, shape=shape, origins=origins))
+
+        budget = settings.QUERY_BUDGETS.get(view_name)
+        if budget is not None and recorder.count > budget:
+            message = '{view} ran {count} queries, budget is {budget}: {top}'.format(
+                view=view_name, count=recorder.count, budget=budget,
+                top='; '.join('%dx %s' % (c, s) for s, c in recorder.shapes.most_common(5)))
+            if settings.QUERY_BUDGET_RAISE:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
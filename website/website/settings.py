@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+import sys
 from configparser import RawConfigParser
 from inspect import currentframe, getframeinfo
 from pathlib import Path
@@ -39,6 +40,8 @@ DEBUG = True
 
 ALLOWED_HOSTS = ["*"]
 
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -67,8 +70,29 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'website.middleware.QueryBudgetMiddleware',
 ]
 
+# per-request SQL query counting, see website.middleware.QueryBudgetMiddleware
+QUERY_BUDGET_ENABLED = DEBUG or TESTING
+QUERY_BUDGET_RAISE = TESTING
+QUERY_REPEAT_THRESHOLD = 5
+# queries of a page rendered on a cold cache, measured by blog.tests.QueryBudgetTest; the shared
+# sidebar takes 9 of them, slug, category and site domain snapshots the rest beyond the page's own
+QUERY_BUDGETS = {
+    'blog:index': 14,
+    'blog:index_page': 14,
+    'blog:category_detail': 18,
+    'blog:category_detail_page': 18,
+    'blog:tag_detail': 17,
+    'blog:tag_detail_page': 17,
+    'blog:author_detail': 17,
+    'blog:author_detail_page': 17,
+    'blog:archive': 14,
+    'blog:archive_page': 14,
+    'blog:detailbyid': 16,
+}
+
 ROOT_URLCONF = 'website.urls'
 AUTH_USER_MODEL = 'accounts.BlogUser'
 LOGIN_URL = '/login/'
@@ -78,17 +102,57 @@ SITE_DESCRIPTION = 'Abhilash Joseph Blog'
 SITE_SEO_DESCRIPTION = 'Abhilash Joseph Blog'
 SITE_SEO_KEYWORDS = 'linux,apache,mysql,ubuntu,shell,web,csharp,.net,asp,mac,swift,python,django'
 ARTICLE_SUB_LENGTH = 300
+ARTICLE_SUMMARY_WORDS = 20
+# render long markdown block by block so edits only re-render the changed blocks
+MARKDOWN_INCREMENTAL_RENDER = True
+MARKDOWN_INCREMENTAL_MIN_LENGTH = 4000
 SHOW_GOOGLE_ADSENSE = False
 PAGINATE_BY = 10
+# seek by (pub_time, id) with ?cursor= links instead of OFFSET pages with a COUNT
+KEYSET_PAGINATION = False
+# article views are buffered per worker and written in one UPDATE
+VIEW_COUNT_FLUSH_INTERVAL = 60
+VIEW_COUNT_FLUSH_THRESHOLD = 100
 CACHE_CONTROL_MAX_AGE = 2592000
 
 # cache setting
 CACHES = {
+    # hot keys are served from a short-lived in-process copy, everything else from memcached
     'default': {
+        'BACKEND': 'website.cache_backends.TieredCache',
+        'LOCATION': 'memcache',
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 5,
+            'STAMP_CHECK_INTERVAL': 1,
+            # only the first index page; keys written on every view flush, like most_read_articles,
+            # would move the stamp and drop every worker's L1
+            'L1_KEYS': ['index_1', 'index_keyset_1', 'seo_processor'],
+            'L1_KEY_PREFIXES': ['template.cache.', 'cache_tag_', 'snapshot_'],
+        },
+    },
+    # stops waiting on memcached while it is slow or down, see website.cache_backends.CircuitBreakerCache
+    'memcache': {
+        'BACKEND': 'website.cache_backends.CircuitBreakerCache',
+        'LOCATION': 'memcached',
+        'OPTIONS': {
+            'SLOW_CALL_TIMEOUT': 0.1,
+            'WINDOW': 20,
+            'MIN_CALLS': 5,
+            'FAILURE_RATE': 0.5,
+            'RECOVERY_TIMEOUT': 10,
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 300,
+        },
+    },
+    'memcached': {
         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
         'LOCATION': '127.0.0.1:11211',
         'KEY_PREFIX': 'djangoblog',
-        'TIMEOUT': 60 * 60 * 10
+        'TIMEOUT': 60 * 60 * 10,
+        'OPTIONS': {
+            'socket_timeout': 0.5,
+        },
     },
     'locmemcache': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -1,16 +1,32 @@
+import datetime
+import functools
 import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from hashlib import md5
 
 import mistune
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from mistune import escape, escape_link
 from pygments import highlight
 from pygments.formatters import html
 from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever BlogMarkDownRenderer output changes so stored html is rebuilt.
+# get_markdown_render_version() adds the site domain, which decides what links get nofollow.
+MARKDOWN_RENDER_VERSION = '1'
+MARKDOWN_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+_site_domain = None
+_markdown_local = threading.local()
+
 
 def get_max_articleid_commentid():
     from blog.models import Article
@@ -23,56 +39,324 @@ def get_md5(str):
     return m.hexdigest()
 
 
-def cache_decorator(expiration=3 * 60):
+def get_cache_key_part(value):
+    """A representation of a call argument that is the same in every process.
+
+    Model instances are identified by label, pk and last modification time, so an edit
+    yields a new key; reprs that may carry memory addresses are rejected.
+    """
+    from django.db.models import Model
+
+    if isinstance(value, Model):
+        return '{label}:{pk}:{version}'.format(label=value._meta.label_lower, pk=value.pk,
+                                               version=getattr(value, 'last_mod_time', ''))
+    if isinstance(value, (list, tuple)):
+        return '[{0}]'.format(','.join(get_cache_key_part(v) for v in value))
+    if isinstance(value, dict):
+        return '{{{0}}}'.format(','.join('%s=%s' % (get_cache_key_part(k), get_cache_key_part(v))
+                                         for k, v in sorted(value.items(), key=lambda i: repr(i[0]))))
+    if value is None or isinstance(value, (str, bytes, int, float, bool, datetime.date, datetime.time)):
+        return repr(value)
+    raise TypeError('cannot build a stable cache key from {value!r}'.format(value=value))
+
+
+def get_decorated_cache_key(func, version, args, kwargs):
+    try:
+        key = args[0].get_cache_key()
+    except Exception:
+        key = None
+    if not key:
+        unique_str = '{module}.{name}:v{version}:{args}:{kwargs}'.format(
+            module=func.__module__, name=func.__qualname__, version=version,
+            args=get_cache_key_part(args), kwargs=get_cache_key_part(kwargs))
+        key = 'cache_decorator_' + get_md5(unique_str)
+    return key
+
+
+def cache_decorator(expiration=3 * 60, version=1, lock_timeout=30):
+    """Cache the result of a function or method in the shared cache.
+
+    Keys come from the function's qualified name, version and arguments, so every worker
+    agrees on them; bump version when the result format changes. Entries are served fresh
+    for expiration seconds and then stale for as long again while one caller refreshes
+    them; concurrent misses wait for a single computation instead of all running it.
+    """
+
     def wrapper(func):
+        @functools.wraps(func)
         def news(*args, **kwargs):
-            try:
-                view = args[0]
-                key = view.get_cache_key()
-            except:
-                key = None
-                pass
-            if not key:
-                unique_str = repr((func, args, kwargs))
-
-                m = md5(unique_str.encode('utf-8'))
-                key = m.hexdigest()
-            value = cache.get(key)
-            if value:
-                logger.info('cache_decorator get cache:%s key:%s' % (func.__name__, key))
-                return value
-            else:
+            key = get_decorated_cache_key(func, version, args, kwargs)
+            lock_key = key + '_lock'
+
+            def compute():
                 logger.info('cache_decorator set cache:%s key:%s' % (func.__name__, key))
-                value = func(*args, **kwargs)
-                cache.set(key, value, expiration)
-                return value
+                try:
+                    value = func(*args, **kwargs)
+                    cache.set(key, (value, time.time() + expiration), expiration * 2)
+                    return value
+                finally:
+                    cache.delete(lock_key)
+
+            entry = cache.get(key)
+            if entry is not None:
+                value, fresh_until = entry
+                if time.time() < fresh_until or not cache.add(lock_key, 1, lock_timeout):
+                    logger.info('cache_decorator get cache:%s key:%s' % (func.__name__, key))
+                    return value
+                return compute()
+
+            deadline = time.time() + lock_timeout
+            while not cache.add(lock_key, 1, lock_timeout):
+                # someone else is computing it
+                if time.time() > deadline:
+                    return func(*args, **kwargs)
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return entry[0]
+            return compute()
 
         return news
 
     return wrapper
 
 
+def get_cache_tag_key(tag):
+    return 'cache_tag_{tag}'.format(tag=tag)
+
+
+def get_cache_tag_generations(tags, values=None):
+    """Current generation of each dependency tag; tags never seen before start at the current time.
+
+    Starting from the clock means a generation key lost from the cache comes back with a new
+    value, so entries stored under the old one still read as stale.
+    """
+    keys = {tag: get_cache_tag_key(tag) for tag in tags}
+    if values is None:
+        values = cache.get_many(keys.values())
+    missing = [key for key in keys.values() if key not in values]
+    if missing:
+        for key in missing:
+            cache.add(key, int(time.time() * 1000), None)
+        values = dict(values, **cache.get_many(missing))
+    return {tag: values.get(key) for tag, key in keys.items()}
+
+
+def cache_get_tagged(key, tags):
+    """Returns (value, generations) for an entry stored with cache_set_tagged.
+
+    value is None when the entry is missing or one of its tags was invalidated since it was
+    stored; generations are the current ones, to hand to cache_set_tagged after recomputing.
+    """
+    values = cache.get_many([key] + [get_cache_tag_key(tag) for tag in tags])
+    generations = get_cache_tag_generations(tags, values)
+    entry = values.get(key)
+    if entry is None or entry['tags'] != generations:
+        return None, generations
+    return entry['value'], generations
+
+
+def cache_set_tagged(key, value, generations, timeout=None):
+    """Store value under key, valid until one of the tags in generations is invalidated."""
+    entry = {'value': value, 'tags': generations}
+    if timeout is None:
+        cache.set(key, entry)
+    else:
+        cache.set(key, entry, timeout)
+
+
+def invalidate_cache_tags(*tags):
+    """Expire every entry stored under these tags by moving their generations forward."""
+    for tag in set(tags):
+        key = get_cache_tag_key(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), None)
+    logger.info('invalidate cache tags:{tags}'.format(tags=','.join(map(str, tags))))
+
+
+def get_site_domain():
+    """Domain of the current Site, looked up once per process until any worker changes the Site."""
+    if _site_domain is not None:
+        return _site_domain
+    return site_domain.get()
+
+
+def set_site_domain(domain):
+    """Use domain in this process without looking up the Site, e.g. in render workers."""
+    global _site_domain
+    _site_domain = domain
+
+
+def load_site_domain():
+    # get_current() caches the Site per process, and only the saving process drops it
+    Site.objects.clear_cache()
+    return Site.objects.get_current().domain
+
+
+def get_markdown_render_version(site_domain=None):
+    site_domain = site_domain or get_site_domain()
+    return '{version}.{domain}'.format(version=MARKDOWN_RENDER_VERSION, domain=get_md5(site_domain)[:8])
+
+
+def get_nofollow(link, site_domain=None):
+    site_domain = site_domain or get_site_domain()
+    return "" if link.find(site_domain) > 0 else "rel='nofollow'"
+
+
+class LRUCache():
+    """Bounded, thread-safe in-process LRU map with hit/miss counters and an optional TTL."""
+    _missing = object()
+
+    def __init__(self, maxsize=256, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires = self._data.get(key, (self._missing, None))
+            if value is not self._missing and expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                value = self._missing
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        """Store value; timeout can only shorten the cache-wide TTL."""
+        if timeout is None or (self.timeout is not None and timeout > self.timeout):
+            timeout = self.timeout
+        expires = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class ProcessSnapshot():
+    """A read-only value built once per process and shared by its threads.
+
+    A generation stamp in the shared cache tells every worker when to rebuild:
+    expire() replaces the stamp, and each process rebuilds on its next get().
+    """
+
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+        self.stamp_key = 'snapshot_{name}'.format(name=name)
+        self._lock = threading.Lock()
+        self._value = None
+        self._stamp = None
+
+    def get_stamp(self):
+        stamp = cache.get(self.stamp_key)
+        if stamp is None:
+            cache.add(self.stamp_key, uuid.uuid4().hex, None)
+            stamp = cache.get(self.stamp_key)
+        return stamp
+
+    def get(self):
+        stamp = self.get_stamp()
+        value = self._value
+        if value is None or stamp is None or stamp != self._stamp:
+            with self._lock:
+                if self._value is None or stamp is None or stamp != self._stamp:
+                    logger.info('build snapshot:{name}'.format(name=self.name))
+                    self._value = self.build()
+                    self._stamp = stamp
+                value = self._value
+        return value
+
+    def expire(self):
+        cache.set(self.stamp_key, uuid.uuid4().hex, None)
+        self._value = None
+
+
+site_domain = ProcessSnapshot('site_domain', load_site_domain)
+
+
+# (lang, inlinestyles, linenos) -> (lexer, formatter), or None when pygments has no such lexer
+highlighter_registry = LRUCache(maxsize=128)
+highlighted_code_cache = LRUCache(maxsize=1024)
+
+
+def get_highlighter(lang, inlinestyles=False, linenos=False):
+    key = (lang, bool(inlinestyles), bool(linenos))
+    highlighter = highlighter_registry.get(key, LRUCache._missing)
+    if highlighter is LRUCache._missing:
+        try:
+            lexer = get_lexer_by_name(lang, stripall=True)
+        except ClassNotFound:
+            highlighter = None
+        else:
+            highlighter = (lexer, html.HtmlFormatter(noclasses=inlinestyles, linenos=linenos))
+        highlighter_registry.set(key, highlighter)
+    return highlighter
+
+
+def get_highlight_stats():
+    return {
+        'highlighters': highlighter_registry.stats(),
+        'snippets': highlighted_code_cache.stats(),
+    }
+
+
 def block_code(text, lang, inlinestyles=False, linenos=False):
     if not lang:
         text = text.strip()
         return u'<pre><code>%s</code></pre>\n' % mistune.escape(text)
 
-    try:
-        lexer = get_lexer_by_name(lang, stripall=True)
-        formatter = html.HtmlFormatter(
-            noclasses=inlinestyles, linenos=linenos
-        )
-        code = highlight(text, lexer, formatter)
-        if linenos:
-            return '<div class="highlight">%s</div>\n' % code
+    key = get_md5('\0'.join((lang, str(bool(inlinestyles)), str(bool(linenos)), text)))
+    code = highlighted_code_cache.get(key)
+    if code is not None:
         return code
-    except:
-        return '<pre class="%s"><code>%s</code></pre>\n' % (
+
+    highlighter = get_highlighter(lang, inlinestyles, linenos)
+    code = None
+    if highlighter is not None:
+        lexer, formatter = highlighter
+        try:
+            code = highlight(text, lexer, formatter)
+            if linenos:
+                code = '<div class="highlight">%s</div>\n' % code
+        except Exception as e:
+            logger.warning('highlight failed for lang %s: %s' % (lang, e))
+            code = None
+    if code is None:
+        code = '<pre class="%s"><code>%s</code></pre>\n' % (
             lang, mistune.escape(text)
         )
+    highlighted_code_cache.set(key, code)
+    return code
 
 
 class BlogMarkDownRenderer(mistune.Renderer):
+    # set by CommonMarkdown.get_markdown before each render, so links do not look it up one by one
+    site_domain = None
+
     def block_code(self, text, lang=None):
         # renderer has an options
         inlinestyles = self.options.get('inlinestyles')
@@ -86,14 +370,12 @@ class BlogMarkDownRenderer(mistune.Renderer):
             link = 'mailto:%s' % link
         if not link:
             link = "#"
-        site = Site.objects.get_current()
-        nofollow = "" if link.find(site.domain) > 0 else "rel='nofollow'"
+        nofollow = get_nofollow(link, self.site_domain)
         return '<a href="%s" %s>%s</a>' % (link, nofollow, text)
 
     def link(self, link, title, text):
         link = escape_link(link)
-        site = Site.objects.get_current()
-        nofollow = "" if link.find(site.domain) > 0 else "rel='nofollow'"
+        nofollow = get_nofollow(link, self.site_domain)
         if not link:
             link = "#"
         if not title:
@@ -102,10 +384,110 @@ class BlogMarkDownRenderer(mistune.Renderer):
         return '<a href="%s" title="%s" %s>%s</a>' % (link, title, nofollow, text)
 
 
+def split_markdown_blocks(value):
+    """Split markdown into top-level blocks as mistune's block lexer sees them.
+
+    Returns a list of (tokens, source) pairs, or None when the document cannot be
+    rendered block by block: reference links and footnotes are resolved document-wide.
+    """
+    lexer = mistune.BlockLexer()
+    text = mistune.preprocessing(value).rstrip('\n')
+    blocks = []
+    while text:
+        start = len(lexer.tokens)
+        for key in lexer.default_rules:
+            m = getattr(lexer.rules, key).match(text)
+            if m:
+                getattr(lexer, 'parse_%s' % key)(m)
+                break
+        else:
+            return None
+        tokens = lexer.tokens[start:]
+        source = m.group(0)
+        text = text[len(source):]
+        if not tokens or tokens[0]['type'] == 'newline':
+            # newlines render to nothing
+            continue
+        if tokens[0]['type'] == 'text' and blocks and blocks[-1][0][-1]['type'] == 'text':
+            # consecutive text tokens are joined into one paragraph when rendered
+            blocks[-1] = (blocks[-1][0] + tokens, blocks[-1][1] + source)
+            continue
+        blocks.append((tokens, source))
+    if lexer.def_links or lexer.def_footnotes:
+        return None
+    return blocks
+
+
+def _is_standalone_block(tokens, source):
+    # a block renders the same on its own only if it lexes to the same tokens without its neighbours
+    blocks = split_markdown_blocks(source)
+    return blocks is not None and [t for block_tokens, _ in blocks for t in block_tokens] == tokens
+
+
 class CommonMarkdown():
     @staticmethod
-    def get_markdown(value):
+    def create_markdown():
         renderer = BlogMarkDownRenderer(inlinestyles=False)
+        return mistune.Markdown(escape=True, renderer=renderer)
 
-        mdp = mistune.Markdown(escape=True, renderer=renderer)
+    @staticmethod
+    def get_parser():
+        """One parser per thread: mistune.Markdown resets its state per call but is not thread-safe."""
+        mdp = getattr(_markdown_local, 'parser', None)
+        if mdp is None:
+            mdp = CommonMarkdown.create_markdown()
+            _markdown_local.parser = mdp
+        return mdp
+
+    @staticmethod
+    def get_markdown(value, site_domain=None):
+        mdp = CommonMarkdown.get_parser()
+        mdp.renderer.site_domain = site_domain or get_site_domain()
         return mdp(value)
+
+    @staticmethod
+    def get_cache_key(value, site_domain=None):
+        return 'markdown_{version}_{digest}'.format(version=get_markdown_render_version(site_domain),
+                                                    digest=get_md5(value))
+
+    @staticmethod
+    def get_cached_markdown(value):
+        """Render markdown, reusing html cached under a hash of the source and renderer version."""
+        site_domain = get_site_domain()
+        key = CommonMarkdown.get_cache_key(value, site_domain)
+        html = cache.get(key)
+        if html is None:
+            if settings.MARKDOWN_INCREMENTAL_RENDER and len(value) >= settings.MARKDOWN_INCREMENTAL_MIN_LENGTH:
+                html = CommonMarkdown.get_incremental_markdown(value, site_domain)
+            if html is None:
+                html = CommonMarkdown.get_markdown(value, site_domain)
+            cache.set(key, html, MARKDOWN_CACHE_TIMEOUT)
+        return html
+
+    @staticmethod
+    def get_incremental_markdown(value, site_domain=None):
+        """Render block by block, reusing cached html of unchanged blocks.
+
+        Returns None when the document has to be rendered as a whole.
+        """
+        blocks = split_markdown_blocks(value)
+        if blocks is None:
+            return None
+        site_domain = site_domain or get_site_domain()
+        version = get_markdown_render_version(site_domain)
+        # a block is only cached once it proved standalone; keying on the tokens it lexed to here as well
+        # means a hit is standalone in this document too, without lexing it again
+        keys = ['markdown_block_{version}_{digest}'.format(version=version, digest=get_md5(repr(tokens) + source))
+                for tokens, source in blocks]
+        rendered = cache.get_many(keys)
+        missing = {}
+        for key, (tokens, source) in zip(keys, blocks):
+            if key in rendered or key in missing:
+                continue
+            if not _is_standalone_block(tokens, source):
+                return None
+            missing[key] = CommonMarkdown.get_markdown(source, site_domain)
+        if missing:
+            cache.set_many(missing, MARKDOWN_CACHE_TIMEOUT)
+            rendered.update(missing)
+        return ''.join(rendered[key] for key in keys)